@@ -0,0 +1,278 @@
+import torch
+import numpy as np
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+###
+# Throughput benchmarks on synthetic graphs shaped like C_15, T_20 and the T_22 communities
+# (--scale multiplies nodes and edges), so speed can be tracked without the real data:
+#   train   iterations/s of the training scripts and test batches/s of their test_loop (run as
+#           subprocesses with --profile, extra args are passed through)
+#   sample  NeighborLoader batches/s and sampled nodes/s per fan-out
+#   serve   AdaBot-serve.py scoring latency per batch size and fan-out, and with --embedding_cache
+# Results are written as a flat {metric: value} JSON baseline; --compare flags metrics that got
+# worse than a previous baseline by more than --tolerance.
+###
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Node/edge counts of the real datasets (T_22 communities: ~7700-7900 accounts and a few thousand
+# edges each); in-degrees are skewed so a few hubs dominate the sampled neighborhoods.
+SHAPES = OrderedDict([
+    ("C_15",{"layout":"dataset","num_nodes":5_301,"num_edges":14_220,"meta_size":6}),
+    ("T_20",{"layout":"dataset","num_nodes":11_826,"num_edges":16_908,"meta_size":6}),
+    ("com5",{"layout":"community","num_nodes":7_725,"num_edges":2_247,"meta_size":8}),
+    ("com6",{"layout":"community","num_nodes":7_918,"num_edges":5_533,"meta_size":8}),
+])
+TEXT_SIZE = 768
+NUM_RELATIONS = 2
+
+
+def get_time():
+    return str(time.strftime("[%Y-%m-%d %H:%M:%S]", time.localtime()))
+
+
+def synth_graph(num_nodes,num_edges,meta_size,gen):
+    label = torch.randint(0,2,(num_nodes,),generator=gen)
+    text = torch.randn(num_nodes,TEXT_SIZE,generator=gen)
+    meta = torch.randn(num_nodes,meta_size,generator=gen,dtype=torch.float64).abs()*100 # count-like, unnormalized
+    hubs = torch.randperm(num_nodes,generator=gen)
+    weight = (torch.arange(num_nodes,dtype=torch.float64)+1)**-0.8
+    dst = hubs[torch.multinomial(weight,num_edges,replacement=True,generator=gen)]
+    src = torch.randint(0,num_nodes,(num_edges,),generator=gen)
+    edge_index = torch.stack([src,dst])
+    edge_type = torch.randint(0,NUM_RELATIONS,(num_edges,),generator=gen)
+    return label,text,meta,edge_index,edge_type
+
+
+def write_synthetic(work_dir,scale,seed):
+    """Writes every SHAPES graph in the Pre_Data layouts; reused when it already exists at this scale and seed."""
+    stamp_path = os.path.join(work_dir,"synthetic.json")
+    stamp = {"scale":scale,"seed":seed,"shapes":SHAPES}
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == json.loads(json.dumps(stamp)):
+                return
+    gen = torch.Generator().manual_seed(seed)
+    com_root = os.path.join(work_dir,"T_22_com")
+    os.makedirs(com_root,exist_ok=True)
+    for name,shape in SHAPES.items():
+        num_nodes,num_edges = int(shape["num_nodes"]*scale),int(shape["num_edges"]*scale)
+        label,text,meta,edge_index,edge_type = synth_graph(num_nodes,num_edges,shape["meta_size"],gen)
+        if shape["layout"] == "dataset":
+            root = os.path.join(work_dir,name)
+            os.makedirs(root,exist_ok=True)
+            perm = torch.randperm(num_nodes,generator=gen)
+            train_mask = torch.zeros(num_nodes,dtype=torch.bool)
+            test_mask = torch.zeros(num_nodes,dtype=torch.bool)
+            train_mask[perm[:int(0.7*num_nodes)]] = True
+            test_mask[perm[int(0.7*num_nodes):int(0.9*num_nodes)]] = True
+            for key,value in (("label",label),("text",text),("meta",meta),("egde_index",edge_index),("egde_type",edge_type),
+                              ("train_mask",train_mask),("test_mask",test_mask)):
+                torch.save(value,os.path.join(root,f"{key}.pt"))
+        else:
+            meta = meta.float()
+            mean,std = meta.mean(dim=0),meta.std(dim=0)
+            for key,value in (("label",label),("text",text),("meta",(meta-mean)/std),("edge_index",edge_index),("edge_type",edge_type),
+                              ("meta_mean",mean),("meta_std",std)):
+                torch.save(value,os.path.join(com_root,f"{name}_{key}.pt"))
+        print(get_time(),f"Synthetic {name}: {num_nodes} nodes, {num_edges} edges")
+    with open(stamp_path,"w") as f:
+        json.dump(stamp,f)
+
+
+def load_synthetic(work_dir,name):
+    shape = SHAPES[name]
+    if shape["layout"] == "dataset":
+        load = lambda key: torch.load(os.path.join(work_dir,name,f"{key}.pt"))
+        meta = load("meta").float()
+        meta = (meta-meta.mean(dim=0))/meta.std(dim=0)
+        return meta,load("text"),load("egde_index"),load("egde_type")
+    load = lambda key: torch.load(os.path.join(work_dir,"T_22_com",f"{name}_{key}.pt"))
+    return load("meta"),load("text"),load("edge_index"),load("edge_type")
+
+
+################################################################################################
+def bench_train(args,extra,results):
+    jobs = [("dataset",["AdaBot-cross-dataset.py","--data_root_path",args.work_dir+os.sep,"--src_data","C_15","--tgt_data","T_20"],
+             int(SHAPES["T_20"]["num_nodes"]*args.scale*0.2)),
+            ("community",["AdaBot-cross-community.py","--data_root_path",os.path.join(args.work_dir,"T_22_com")+os.sep,
+                          "--exp_all","false","--coms","5-6"],
+             int(SHAPES["com6"]["num_nodes"]*args.scale*0.1))]
+    for mode,cmd,num_test in jobs:
+        profile_path = os.path.join(args.work_dir,f"profile_{mode}.jsonl")
+        if os.path.exists(profile_path):
+            os.remove(profile_path)
+        cmd = [args.python,os.path.join(HERE,cmd[0])]+cmd[1:]+[
+            "--device",args.device,"--exp_times","1","--seed",str(args.seed),"--iterations",str(args.iterations),
+            "--test_report",str(args.iterations),"--train_report",str(args.iterations),"--batch_size",str(args.batch_size),
+            "--profile",profile_path]+extra
+        log_path = os.path.join(args.work_dir,f"train_{mode}.log")
+        print(get_time(),f"train/{mode}:"," ".join(cmd))
+        with open(log_path,"w") as log:
+            returncode = subprocess.call(cmd,stdout=log,stderr=subprocess.STDOUT)
+        if returncode != 0 or not os.path.exists(profile_path):
+            print(get_time(),f"train/{mode} FAILED (exit {returncode}), see {log_path}")
+            continue
+        with open(profile_path) as f:
+            records = [json.loads(line) for line in f]
+        steady = records[args.warmup:] or records
+        # Iterations that run a test also count its time in total_ms; only the training phases count here
+        train_ms = np.array([r["total_ms"]-(r.get("test_ms") or 0) for r in steady])
+        results[f"train.{mode}.it_per_s"] = float(1000/train_ms.mean())
+        for key in steady[0]:
+            if key.endswith("_ms") and key not in ("total_ms","test_ms"):
+                values = [r[key] for r in steady if r[key] is not None]
+                if values:
+                    results[f"train.{mode}.{key}"] = float(np.mean(values))
+        test_ms = [r["test_ms"] for r in records if r.get("test_ms") is not None]
+        if test_ms:
+            results[f"test.{mode}.batch_per_s"] = math.ceil(num_test/args.batch_size)/(test_ms[-1]/1000)
+        print(get_time(),f"train/{mode}: {results[f'train.{mode}.it_per_s']:.2f} it/s")
+
+
+def bench_sample(args,results):
+    from torch_geometric.data import Data
+    from torch_geometric.loader import NeighborLoader
+    for name in args.graphs:
+        meta,text,edge_index,edge_type = load_synthetic(args.work_dir,name)
+        data = Data(meta=meta,text=text,edge_index=edge_index,edge_type=edge_type,num_nodes=meta.shape[0])
+        for fan_out in args.fan_outs:
+            loader = NeighborLoader(data,num_neighbors=fan_out,batch_size=args.batch_size,shuffle=True)
+            batches,nodes,start = 0,0,None
+            while batches < args.sample_batches:
+                for batch in loader:
+                    if start is None:
+                        start = time.perf_counter() # first batch is warmup
+                        continue
+                    batches += 1
+                    nodes += batch.num_nodes
+                    if batches >= args.sample_batches:
+                        break
+            elapsed = time.perf_counter()-start
+            key = f"sample.{name}.fanout{'x'.join(map(str,fan_out))}"
+            results[f"{key}.batch_per_s"] = batches/elapsed
+            results[f"{key}.nodes_per_s"] = nodes/elapsed
+            print(get_time(),f"{key}: {batches/elapsed:.1f} batches/s, {nodes/elapsed:.0f} nodes/s")
+
+
+def bench_serve(args,results):
+    spec = importlib.util.spec_from_file_location("adabot_serve",os.path.join(HERE,"AdaBot-serve.py"))
+    serve = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(serve)
+    gen = torch.Generator().manual_seed(args.seed)
+    for name in args.graphs:
+        meta,text,edge_index,edge_type = load_synthetic(args.work_dir,name)
+        torch.manual_seed(args.seed)
+        model_f = serve.ABot_Feature_Generator(128,TEXT_SIZE,meta.shape[1],0.5,NUM_RELATIONS,2,"relu").to(args.device).eval()
+        model_c = serve.ABot_Classifier(128,0.5,"relu").to(args.device).eval()
+        graph = serve.GraphIndex(meta,text,edge_index,edge_type)
+        for fan_out in args.fan_outs:
+            scorer = serve.BotScorer(model_f,model_c,graph,fan_out,device=args.device)
+            for batch_size in args.score_batch_sizes:
+                latencies = []
+                for _ in range(args.repeats+1):
+                    seeds = torch.randperm(graph.num_nodes,generator=gen)[:batch_size].sort()[0]
+                    start = time.perf_counter()
+                    scorer.predict(seeds)
+                    latencies.append(time.perf_counter()-start)
+                key = f"serve.{name}.fanout{'x'.join(map(str,fan_out))}.batch{batch_size}"
+                results[f"{key}.p50_ms"] = float(np.percentile(latencies[1:],50)*1000)
+                results[f"{key}.p99_ms"] = float(np.percentile(latencies[1:],99)*1000)
+                print(get_time(),f"{key}: p50 {results[f'{key}.p50_ms']:.2f} ms")
+        # Exact full-neighborhood scoring: cold (empty cache) and warm (every score cached)
+        scorer = serve.BotScorer(model_f,model_c,graph,device=args.device,embedding_cache=True)
+        for batch_size in args.score_batch_sizes:
+            seeds = torch.randperm(graph.num_nodes,generator=gen)[:batch_size].sort()[0]
+            scorer.cache.invalidate(torch.arange(graph.num_nodes),torch.zeros(0,dtype=torch.long))
+            start = time.perf_counter()
+            scorer.predict(seeds)
+            cold = time.perf_counter()-start
+            start = time.perf_counter()
+            scorer.predict(seeds)
+            warm = time.perf_counter()-start
+            key = f"serve.{name}.cache.batch{batch_size}"
+            results[f"{key}.cold_ms"] = cold*1000
+            results[f"{key}.warm_ms"] = warm*1000
+            print(get_time(),f"{key}: cold {cold*1000:.2f} ms, warm {warm*1000:.3f} ms")
+
+
+################################################################################################
+def compare(results,baseline,tolerance):
+    """Metrics worse than the baseline by more than tolerance (relative); *_ms are lower-is-better."""
+    regressions = []
+    for key,value in results.items():
+        if key not in baseline or not baseline[key]:
+            continue
+        ratio = value/baseline[key]
+        worse = ratio-1 if key.endswith("_ms") else 1-ratio
+        status = "REGRESSION" if worse > tolerance else "ok"
+        print(f"{status:>10}  {key}: {baseline[key]:.4g} -> {value:.4g} ({100*(ratio-1):+.1f}%)")
+        if worse > tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def parse_fan_outs(v):
+    # "256,256;32,32" -> [[256,256],[32,32]]
+    return [[int(k) for k in fan_out.split(",")] for fan_out in v.split(";")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AdaBot throughput benchmarks on synthetic graphs")
+    parser.add_argument('--suites', type=str, default="train,sample,serve")
+    parser.add_argument('--work_dir', type=str, default="./bench_data")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the node and edge counts of every graph")
+    parser.add_argument('--graphs', type=str, nargs="*", default=list(SHAPES.keys()), help="graphs for the sample and serve suites")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--python', type=str, default=sys.executable)
+    parser.add_argument('--iterations', type=int, default=200, help="training iterations per script")
+    parser.add_argument('--warmup', type=int, default=20, help="leading iterations left out of it/s")
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--fan_outs', type=parse_fan_outs, default=[[256,256],[32,32],[10,10]], help='e.g. "256,256;32,32"')
+    parser.add_argument('--sample_batches', type=int, default=50)
+    parser.add_argument('--score_batch_sizes', type=int, nargs="*", default=[1,16,128,512])
+    parser.add_argument('--repeats', type=int, default=20, help="scoring calls per batch size")
+    parser.add_argument('--out', type=str, default="./bench_results.json")
+    parser.add_argument('--compare', type=str, default=None, help="baseline JSON written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args,extra = parser.parse_known_args()
+    print(args,"passthrough:",extra)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    suites = args.suites.split(",")
+
+    write_synthetic(args.work_dir,args.scale,args.seed)
+    results = OrderedDict()
+    if "train" in suites:
+        bench_train(args,extra,results)
+    if "sample" in suites:
+        bench_sample(args,results)
+    if "serve" in suites:
+        bench_serve(args,results)
+
+    report = {"env":{"time":get_time(),"python":platform.python_version(),"torch":torch.__version__,"platform":platform.platform(),
+                     "device":args.device,"threads":torch.get_num_threads(),"scale":args.scale,"seed":args.seed,
+                     "iterations":args.iterations,"batch_size":args.batch_size,"passthrough":extra},
+              "results":results}
+    with open(args.out,"w") as f:
+        json.dump(report,f,indent=1)
+    print(f"Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results,json.load(f)["results"],args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {100*args.tolerance:.0f}%")
+            sys.exit(1)
+    print("Done!")
@@ -0,0 +1,92 @@
+import torch
+import argparse
+import glob
+import os
+import re
+from collections import OrderedDict
+from adabot_pack import write_packed,quantize_text,dequantize_text
+
+###
+# Convert the Pre_Data/* .pt layout into the packed single-file format (layout in adabot_pack.py).
+###
+
+
+def pack_text(fields,attrs,text,dtype):
+    stored,scale = quantize_text(text,dtype)
+    restored = dequantize_text(stored,scale)
+    err = restored-text.float()
+    print(f"Text {dtype}: max abs error {err.abs().max().item():.3e}, relative RMS error {(err.norm()/text.float().norm().clamp(min=1e-12)).item():.3e}")
+    fields["text"] = stored.view(torch.int16) if dtype == "bfloat16" else stored
+    if scale is not None:
+        fields["text_scale"] = scale
+    attrs["text_dtype"] = dtype
+
+
+def convert_community(data_root_path,com,out_path,text_dtype="float32"):
+    load = lambda key: torch.load(data_root_path+f"com{com}_{key}.pt",map_location="cpu")
+    fields = OrderedDict()
+    fields["label"] = load("label")
+    attrs = {"layout":"community","com":com,"num_nodes":int(fields["label"].shape[0])}
+    pack_text(fields,attrs,load("text"),text_dtype)
+    fields["meta"] = load("meta")
+    fields["edge_index"] = load("edge_index")
+    edge_type = load("edge_type")
+    edge_type[edge_type==12] = 1
+    fields["edge_type"] = edge_type
+    fields["meta_mean"] = load("meta_mean")
+    fields["meta_std"] = load("meta_std")
+    write_packed(out_path,fields,attrs)
+    return fields
+
+
+def convert_dataset(data_root_path,name,out_path,text_dtype="float32"):
+    load = lambda key: torch.load(os.path.join(data_root_path,name,f"{key}.pt"),map_location="cpu")
+    fields = OrderedDict()
+    fields["label"] = load("label")
+    num_nodes = fields["label"].shape[0]
+    attrs = {"layout":"dataset","name":name,"num_nodes":int(num_nodes)}
+    pack_text(fields,attrs,load("text"),text_dtype)
+    fields["meta"] = load("meta")
+    fields["edge_index"] = load("egde_index")
+    fields["edge_type"] = load("egde_type")
+    if os.path.exists(os.path.join(data_root_path,name,"id.pt")):
+        fields["id"] = load("id")
+    if name == "C_15":
+        fields["train_mask"] = torch.zeros(num_nodes, dtype=torch.bool)
+        fields["test_mask"] = torch.zeros(num_nodes, dtype=torch.bool)
+    else:
+        fields["train_mask"] = load("train_mask")
+        fields["test_mask"] = load("test_mask")
+    write_packed(out_path,fields,attrs)
+    return fields
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Pre_Data/* into packed memory-mapped files")
+    parser.add_argument('--layout', type=str, default="community", help="community, dataset")
+    parser.add_argument('--data_root_path', type=str, default="./Pre_Data/T_22_com/")
+    parser.add_argument('--coms', type=int, nargs="*", default=None, help="communities to convert (default: all found)")
+    parser.add_argument('--names', type=str, nargs="*", default=["C_15","T_20","T_22"])
+    parser.add_argument('--text_dtype', type=str, default="float32", help="float32, float16, bfloat16, int8")
+    args = parser.parse_args()
+    print(args)
+
+    if args.layout == "community":
+        coms = args.coms
+        if coms is None:
+            found = glob.glob(os.path.join(args.data_root_path,"com*_label.pt"))
+            coms = sorted(int(re.search(r"com(\d+)_label\.pt$",path).group(1)) for path in found)
+        for com in coms:
+            out_path = args.data_root_path+f"com{com}.pack"
+            fields = convert_community(args.data_root_path,com,out_path,args.text_dtype)
+            print(f"Com {com} -> {out_path}:",{name:tuple(value.shape) for name,value in fields.items()})
+    elif args.layout == "dataset":
+        for name in args.names:
+            if not os.path.isdir(os.path.join(args.data_root_path,name)):
+                print(f"Skip {name}: no such directory")
+                continue
+            out_path = os.path.join(args.data_root_path,name,"data.pack")
+            fields = convert_dataset(args.data_root_path,name,out_path,args.text_dtype)
+            print(f"Dataset {name} -> {out_path}:",{key:tuple(value.shape) for key,value in fields.items()})
+    else:
+        raise KeyError(args.layout)
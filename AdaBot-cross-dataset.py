@@ -1,21 +1,31 @@
 import warnings
 warnings.filterwarnings("ignore")
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import numpy as np
 from numpy import cos,sin,pi
 from torch import nn
 from torch_geometric.nn import RGCNConv
 from torch_geometric.loader import NeighborLoader
 from torch_geometric.data import Data
-from sklearn.metrics import f1_score,precision_score,accuracy_score,recall_score
 import time
 import torch.nn.functional as F
 import contextlib
 import argparse
-from copy import deepcopy
+import csv
+import json
+import hashlib
+import random
+import tempfile
+import queue
+import threading
+import sys
+from copy import deepcopy,copy
 from sys import stderr
 from collections import OrderedDict
 from torch_geometric.transforms import RandomNodeSplit
+from adabot_pack import load_packed,quantize_text,dequantize_text
 import os
 
 ###
@@ -23,6 +33,10 @@ import os
 ###
 
 
+def str2bool(v):
+    # type=bool would turn "--ssa False" into True
+    return str(v).lower() in ("true","1","yes","y")
+
 parser = argparse.ArgumentParser(description="Parameter Processing")
 
 # BASIC
@@ -30,10 +44,33 @@ parser.add_argument('--data_root_path', type=str,default="./Pre_Data/")
 parser.add_argument('--save_path', type=str)
 parser.add_argument('--exp_times', type=int, default=5)
 parser.add_argument('--device', type=str, default="cuda:0")
+parser.add_argument('--deterministic', action='store_true', help="deterministic kernels where available (slower)")
+parser.add_argument('--ckpt_dir', type=str, default=None, help="checkpoint and per-pair result directory; finished exps are skipped and interrupted ones resumed")
+parser.add_argument('--ckpt_interval', type=int, default=500, help="iterations between checkpoints (0: only record finished exps)")
+parser.add_argument('--packed', action='store_true', help="read memory-mapped .pack files written by AdaBot-convert.py")
+parser.add_argument('--csc_cache', action='store_true', help="sort edges by destination once and cache them next to the data")
+parser.add_argument('--prefetch', type=int, default=0, help="batches sampled ahead by a background thread (0: sample inline); off with --deterministic or --ckpt_dir")
+parser.add_argument('--full_graph_test', action='store_true', help="evaluate layer-wise over the whole target graph instead of sampling")
+parser.add_argument('--infer_chunk', type=int, default=65_536, help="rows per chunk in full-graph evaluation")
+parser.add_argument('--compile', action='store_true', help="torch.compile the EMA shadow models used for evaluation")
+parser.add_argument('--text_dtype', type=str, default="float32", help="float32, float16, bfloat16, int8: in-memory text storage (packed files keep the dtype they were converted with); without --packed the float32 .pt is still read on the host once")
+parser.add_argument('--amp', action='store_true', help="bf16 autocast for the feature generator (training and evaluation)")
+parser.add_argument('--amp_parity', action='store_true', help="with --amp, also evaluate in fp32 on the same batches and report the difference")
+parser.add_argument('--freeze_text', action='store_true', help="freeze text_encoder and train on its cached outputs instead of raw text rows")
+parser.add_argument('--trim', action='store_true', help="layer-wise trimming of sampled batches: each RGCN layer only computes the nodes the next hop needs")
 parser.add_argument('--train_report',type=int,default=100)
+parser.add_argument('--profile', type=str, default=None, help="write per-iteration phase timings to this .jsonl or .csv file")
+parser.add_argument('--profile_sync', action='store_true', help="synchronize CUDA around every phase (accurate GPU timings, slower)")
+parser.add_argument('--profile_trace', type=str, default=None, help="directory for a torch.profiler Chrome trace of a few iterations")
+parser.add_argument('--profile_trace_start', type=int, default=10)
+parser.add_argument('--profile_trace_steps', type=int, default=5)
 parser.add_argument('--test_report',type=int,default=1_000)
 parser.add_argument('--src_data', type=str, default="C_15")
 parser.add_argument('--tgt_data', type=str, default="T_20")
+parser.add_argument('--seed', type=int, default=0, help="exp e is seeded with seed+e")
+parser.add_argument('--ddp_world_size', type=int, default=1, help="data-parallel training over this many local processes (also picked up from torchrun's RANK/WORLD_SIZE); use with --packed so they share the data")
+parser.add_argument('--ddp_backend', type=str, default="gloo")
+parser.add_argument('--ddp_port', type=int, default=29500, help="MASTER_PORT for local --ddp_world_size processes")
 
 # HYPERPARAMETER
 parser.add_argument('--lr', type=float, default=1e-4)
@@ -42,38 +79,132 @@ parser.add_argument('--dropout', type=float, default=0.3)
 parser.add_argument('--hidden_size', type=int, default=128)
 parser.add_argument('--iterations', type=int, default=5_000) # iterations = epochs*(data_nums/batch_size)
 parser.add_argument('--transformer_att_head', type=int, default=2)
-parser.add_argument('--batch_size', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=None, help="seed nodes per batch (512 when unset, or sized to the budget below)")
+parser.add_argument('--budget_nodes', type=int, default=None, help="per-batch node budget: fan-out and batch size are picked per dataset from its degree statistics")
+parser.add_argument('--budget_edges', type=int, default=None, help="per-batch edge budget, as --budget_nodes")
+parser.add_argument('--budget_mb', type=float, default=None, help="per-batch memory budget in MB (rough estimate), as --budget_nodes")
+parser.add_argument('--batching', type=str, default="neighbor", help="neighbor, cluster: 2-hop neighbor sampling, or subgraphs induced by groups of graph partitions")
+parser.add_argument('--part_size', type=int, default=256, help="--batching cluster: nodes per partition (METIS when available, else BFS)")
+parser.add_argument('--parts_per_batch', type=int, default=8, help="--batching cluster: partitions per batch")
 parser.add_argument('--text_input_size', type=int, default=768)
 parser.add_argument('--meta_input_size', type=int, default=6)
 parser.add_argument('--num_relations', type=int, default=2)
 parser.add_argument('--lmd_dis', type=float, default=1.0)
+parser.add_argument('--swd_pool', type=int, default=0, help="draw SWD projections from a fixed pool of this many directions (0: fresh draw)")
+parser.add_argument('--swd_refresh', type=int, default=1, help="redraw SWD projections every N iterations")
 parser.add_argument('--lmd_cet', type=float, default=0.005)
 parser.add_argument('--lmd_vat', type=float, default=0.001)
+parser.add_argument('--fast_vat', action='store_true', help="reuse the clean predictions and run VAT's feature passes once over both domains (the classifier still runs per domain)")
+parser.add_argument('--vat_interval', type=int, default=1, help="compute the VAT term every k iterations, scaled by k so its average weight stays --lmd_vat")
 parser.add_argument('--ema_decay', type=float, default=0.999)
 parser.add_argument('--ema_interval', type = int, default=1)
-parser.add_argument('--meta_align',type=bool,default=True)
-parser.add_argument('--ssa',type=bool,default=True) #Source Signal Annealing
+parser.add_argument('--ema_flat', action='store_true', help="keep model and EMA shadow weights in flat contiguous buffers")
+parser.add_argument('--meta_align',type=str2bool,default=True)
+parser.add_argument('--ssa',type=str2bool,default=True) #Source Signal Annealing
 parser.add_argument('--ssa_schedule',type=str,default="sin",help="linear, cos, sin") # cos: slow->fast; sin: fast->slow
 
 args = parser.parse_args()   
+if args.prefetch > 0 and (args.deterministic or args.ckpt_dir):
+    # The prefetch thread's neighbor sampling draws from the global RNG while the training step does
+    # too, so neither a seeded run nor a resumed one would replay the same stream
+    args.prefetch = 0
+    print("--prefetch is off with --deterministic/--ckpt_dir: sampling inline to keep the RNG stream reproducible")
+
+if args.deterministic:
+    os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG",":4096:8")
+    torch.backends.cudnn.benchmark = False
+    torch.use_deterministic_algorithms(True,warn_only=True) # scatter kernels have no deterministic CUDA version
 ################################################################
+# DDP: every rank samples a disjoint shard of the seed nodes, gradients are averaged before each
+# optimizer step and BN statistics before each EMA update, so models and EMA shadows stay identical
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+def shard_nodes(num_nodes,input_nodes=None):
+    # This rank's share of the seed nodes, from a permutation every rank draws alike
+    index = torch.arange(num_nodes) if input_nodes is None else input_nodes.cpu()
+    if index.dtype == torch.bool:
+        index = index.nonzero().view(-1)
+    perm = torch.randperm(index.shape[0],generator=torch.Generator().manual_seed(args.seed))
+    return index[perm[get_rank()::get_world_size()]].sort()[0]
+
+def broadcast_module(module):
+    for tensor in list(module.parameters())+list(module.buffers()):
+        dist.broadcast(tensor.data,0)
+
+def all_reduce_grads(*modules):
+    # Mean gradient over the ranks, in one collective over a flat buffer
+    params = [param for module in modules for param in module.parameters() if param.grad is not None]
+    flat = torch.cat([param.grad.reshape(-1) for param in params])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for param in params:
+        param.grad.copy_(flat[offset:offset+param.numel()].view_as(param.grad))
+        offset += param.numel()
+
+def average_buffers(module):
+    # BatchNorm running statistics are updated from each rank's own batches
+    for buffer in module.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer)
+            buffer /= get_world_size()
+
+def gather_objects(obj):
+    objs = [None]*get_world_size()
+    dist.all_gather_object(objs,obj)
+    return objs
+
+@contextlib.contextmanager
+def rank0_first():
+    # Rank 0 runs the block first (building any cache files it writes); the other ranks wait for it
+    # and then run the block themselves, finding the caches already in place
+    distributed = get_world_size() > 1
+    if distributed and get_rank() != 0:
+        dist.barrier()
+    yield
+    if distributed and get_rank() == 0:
+        dist.barrier()
+################################################################
+
+def load_text(path):
+    # The .pt text matrix is read on the host and quantized in row chunks, so only the --text_dtype copy
+    # reaches args.device; the host still reads it in float32 once (use --packed to avoid that too)
+    text = torch.load(path,map_location="cpu")
+    chunks = [quantize_text(chunk,args.text_dtype) for chunk in text.split(args.infer_chunk)]
+    scale = None if chunks[0][1] is None else torch.cat([scale for _,scale in chunks]).to(args.device)
+    return torch.cat([chunk for chunk,_ in chunks]).to(args.device),scale
 
 def get_Dataset(data_root_path,name):
     assert name in ["C_15","T_20","T_22"]
 
-    label = torch.load(os.path.join(data_root_path,name,"label.pt"),map_location=args.device)
-    text = torch.load(os.path.join(data_root_path,name,"text.pt"),map_location=args.device)
-    meta = torch.load(os.path.join(data_root_path,name,"meta.pt"),map_location=args.device)
-    meta = meta.type(torch.float32)
-    edge_index = torch.load(os.path.join(data_root_path,name,"egde_index.pt"),map_location=args.device)
-    edge_type = torch.load(os.path.join(data_root_path,name,"egde_type.pt"),map_location=args.device)
-    num_nodes = label.shape[0]
-    if name == "C_15":
-        train_mask = torch.zeros(num_nodes, dtype=torch.bool)
-        test_mask = torch.zeros(num_nodes, dtype=torch.bool)
+    if args.packed:
+        # Stays on the host; batches are moved to args.device after sampling
+        _,fields = load_packed(os.path.join(data_root_path,name,"data.pack"))
+        label,text = fields["label"],fields["text"]
+        text_scale = fields.get("text_scale")
+        meta = fields["meta"].type(torch.float32)
+        edge_index,edge_type = fields["edge_index"],fields["edge_type"]
+        num_nodes = label.shape[0]
+        train_mask,test_mask = fields["train_mask"],fields["test_mask"]
     else:
-        train_mask = torch.load(os.path.join(data_root_path,name,"train_mask.pt"),map_location=args.device) 
-        test_mask = torch.load(os.path.join(data_root_path,name,"test_mask.pt"),map_location=args.device) 
+        label = torch.load(os.path.join(data_root_path,name,"label.pt"),map_location=args.device)
+        text,text_scale = load_text(os.path.join(data_root_path,name,"text.pt"))
+        meta = torch.load(os.path.join(data_root_path,name,"meta.pt"),map_location=args.device)
+        meta = meta.type(torch.float32)
+        edge_index = torch.load(os.path.join(data_root_path,name,"egde_index.pt"),map_location=args.device)
+        edge_type = torch.load(os.path.join(data_root_path,name,"egde_type.pt"),map_location=args.device)
+        num_nodes = label.shape[0]
+        if name == "C_15":
+            train_mask = torch.zeros(num_nodes, dtype=torch.bool)
+            test_mask = torch.zeros(num_nodes, dtype=torch.bool)
+        else:
+            train_mask = torch.load(os.path.join(data_root_path,name,"train_mask.pt"),map_location=args.device) 
+            test_mask = torch.load(os.path.join(data_root_path,name,"test_mask.pt"),map_location=args.device) 
 
     print(f"Dataset: {name}")
     print("Label:",label.shape)
@@ -82,50 +213,517 @@ def get_Dataset(data_root_path,name):
     print("Edge_index:",edge_index.shape)
     print("Edge_type:",edge_type.shape)
 
-    return Data(edge_index=edge_index,
-                y=label,
-                text=text,
-                meta=meta,
-                edge_type=edge_type,
-                num_nodes=num_nodes,
-                train_mask=train_mask,
-                test_mask=test_mask)
+    dataset = Data(edge_index=edge_index,
+                   y=label,
+                   text=text,
+                   meta=meta,
+                   edge_type=edge_type,
+                   num_nodes=num_nodes,
+                   train_mask=train_mask,
+                   test_mask=test_mask)
+    if text_scale is not None:
+        dataset.text_scale = text_scale
+    digest = edge_digest(edge_index,edge_type) if args.csc_cache or args.batching == "cluster" else None
+    with rank0_first():
+        if args.csc_cache:
+            dataset = sort_edges_csc(dataset,os.path.join(data_root_path,name,"csc.pt"),digest)
+        if args.batching == "cluster":
+            dataset.part = get_partition(dataset,args.part_size,os.path.join(data_root_path,name,f"part{args.part_size}.pt"),digest)
+    return dataset
+
+def edge_digest(edge_index,edge_type):
+    # Content hash of a graph's edges: caches derived from them are rebuilt when the graph changes,
+    # even if its node and edge counts do not
+    digest = hashlib.sha1()
+    for tensor in (edge_index,edge_type):
+        digest.update(tensor.cpu().contiguous().numpy())
+    return digest.hexdigest()
+
+def sort_edges_csc(dataset,cache_path,digest):
+    # NeighborLoader sorts edge_index by destination every time it is built unless is_sorted=True;
+    # do it once per dataset and keep the CSC-ordered edges next to the data.
+    cache = torch.load(cache_path,map_location="cpu") if os.path.exists(cache_path) else None
+    if cache is None or cache.get("digest") != digest:
+        edge_index,edge_type = dataset.edge_index.cpu(),dataset.edge_type.cpu()
+        perm = (edge_index[1]*dataset.num_nodes+edge_index[0]).argsort()
+        cache = {"num_nodes":dataset.num_nodes,"digest":digest,"edge_index":edge_index[:,perm].contiguous(),"edge_type":edge_type[perm].contiguous()}
+        atomic_save(cache,cache_path)
+        print(f"CSC cache written to {cache_path}")
+    dataset.edge_index = cache["edge_index"].to(dataset.edge_index.device)
+    dataset.edge_type = cache["edge_type"].to(dataset.edge_type.device)
+    return dataset
+
+def metis_partition(edge_index,num_nodes,num_parts):
+    # METIS through torch_geometric's ClusterData (needs pyg-lib or torch-sparse built with METIS)
+    from torch_geometric.loader import ClusterData
+    from torch_geometric.utils import to_undirected
+    graph = Data(edge_index=to_undirected(edge_index,num_nodes=num_nodes),num_nodes=num_nodes)
+    cluster = ClusterData(graph,num_parts,log=False)
+    if hasattr(cluster,"partition"): # torch_geometric >= 2.4
+        partptr,node_perm = cluster.partition.partptr,cluster.partition.node_perm
+    else:
+        partptr,node_perm = cluster.partptr,cluster.perm
+    part = torch.empty(num_nodes,dtype=torch.long)
+    part[node_perm] = torch.repeat_interleave(torch.arange(partptr.shape[0]-1),partptr.diff())
+    return part
+
+def bfs_partition(edge_index,num_nodes,num_parts):
+    # Fallback: a breadth-first order of the undirected graph cut into num_parts equal runs,
+    # so every part is a set of nearby nodes
+    src,dst = edge_index.numpy()
+    row,col = np.concatenate([src,dst]),np.concatenate([dst,src])
+    col = col[np.argsort(row,kind="stable")]
+    deg = np.bincount(row,minlength=num_nodes)
+    rowptr = np.concatenate([[0],np.cumsum(deg)])
+    visited = np.zeros(num_nodes,dtype=bool)
+    order = []
+    for root in np.flatnonzero(deg):
+        if visited[root]:
+            continue
+        visited[root] = True
+        frontier = np.array([root])
+        while frontier.size:
+            order.append(frontier)
+            lens = deg[frontier]
+            ptr = np.repeat(rowptr[frontier]-np.cumsum(lens)+lens,lens)+np.arange(lens.sum())
+            frontier = np.unique(col[ptr])
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+    order.append(np.flatnonzero(~visited)) # isolated nodes
+    part = np.empty(num_nodes,dtype=np.int64)
+    part[np.concatenate(order)] = np.arange(num_nodes)*num_parts//num_nodes
+    return torch.from_numpy(part)
+
+def get_partition(dataset,part_size,cache_path,digest):
+    # Node -> part id for --batching cluster, with parts of about part_size nodes, computed once and
+    # cached next to the data
+    num_nodes,num_edges = dataset.num_nodes,dataset.edge_index.shape[1]
+    num_parts = max(1,(num_nodes+part_size-1)//part_size)
+    cache = torch.load(cache_path,map_location="cpu") if os.path.exists(cache_path) else None
+    if cache is None or cache.get("digest") != digest or cache["num_parts"] != num_parts:
+        edge_index = dataset.edge_index.cpu()
+        try:
+            part,method = metis_partition(edge_index,num_nodes,num_parts),"metis"
+        except (ImportError,RuntimeError) as err:
+            print(f"METIS unavailable ({err}), partitioning by BFS",file=stderr)
+            part,method = bfs_partition(edge_index,num_nodes,num_parts),"bfs"
+        cache = {"num_nodes":num_nodes,"num_edges":num_edges,"num_parts":num_parts,"digest":digest,"method":method,"part":part}
+        atomic_save(cache,cache_path)
+        print(f"{num_parts} parts ({method}) written to {cache_path}")
+    return cache["part"].to(dataset.edge_index.device)
+
+class ClusterLoader:
+    """--batching cluster: Cluster-GCN style batches, each the subgraph induced by parts_per_batch random
+    parts of dataset.part, so its size is bounded by the part sizes rather than by the fan-out. Same
+    batch interface as NeighborLoader: the input nodes of the chosen parts are the seeds and come first
+    (batch_size of them), n_id maps the rows back to the dataset."""
+    def __init__(self,dataset,input_nodes,parts_per_batch,shuffle=True,generator=None):
+        self.dataset = dataset
+        self.parts_per_batch = parts_per_batch
+        self.shuffle = shuffle
+        self.generator = generator
+        self.node_keys = [key for key in ("y","meta","text","text_scale") if key in dataset]
+        part = dataset.part
+        device = part.device
+        num_parts = int(part.max())+1
+        if input_nodes is None:
+            self.is_seed = torch.ones(dataset.num_nodes,dtype=torch.bool,device=device)
+        elif input_nodes.dtype == torch.bool:
+            self.is_seed = input_nodes.to(device)
+        else:
+            self.is_seed = torch.zeros(dataset.num_nodes,dtype=torch.bool,device=device)
+            self.is_seed[input_nodes.to(device)] = True
+        bounds = torch.arange(num_parts+1,device=device)
+        node_perm = part.argsort()
+        node_ptr = torch.searchsorted(part[node_perm],bounds).tolist()
+        self.part_nodes = [node_perm[node_ptr[i]:node_ptr[i+1]] for i in range(num_parts)]
+        self.parts = torch.unique(part[self.is_seed]).tolist() # parts with at least one seed
+        # Edges grouped by the part of their destination
+        edge_part = part[dataset.edge_index[1]]
+        edge_perm = edge_part.argsort()
+        self.edge_index = dataset.edge_index[:,edge_perm]
+        self.edge_type = dataset.edge_type[edge_perm]
+        self.edge_ptr = torch.searchsorted(edge_part[edge_perm],bounds).tolist()
+
+    def __len__(self):
+        return (len(self.parts)+self.parts_per_batch-1)//self.parts_per_batch
+
+    def __iter__(self):
+        order = torch.randperm(len(self.parts),generator=self.generator).tolist() if self.shuffle else range(len(self.parts))
+        parts = [self.parts[i] for i in order]
+        for i in range(0,len(parts),self.parts_per_batch):
+            yield self._batch(parts[i:i+self.parts_per_batch])
+
+    def _batch(self,parts):
+        nodes = torch.cat([self.part_nodes[p] for p in parts])
+        seed = self.is_seed[nodes]
+        n_id = torch.cat([nodes[seed],nodes[~seed]])
+        local = torch.full((self.dataset.num_nodes,),-1,dtype=torch.long,device=n_id.device)
+        local[n_id] = torch.arange(n_id.shape[0],device=n_id.device)
+        edge_ids = torch.cat([torch.arange(self.edge_ptr[p],self.edge_ptr[p+1],device=n_id.device) for p in parts])
+        edge_index = local[self.edge_index[:,edge_ids]]
+        keep = edge_index[0] >= 0 # source inside the chosen parts as well
+        batch = Data(edge_index=edge_index[:,keep],edge_type=self.edge_type[edge_ids][keep],num_nodes=n_id.shape[0])
+        batch.n_id = n_id
+        batch.batch_size = int(seed.sum())
+        for key in self.node_keys:
+            batch[key] = self.dataset[key][n_id]
+        return batch
+
+FAN_OUTS = [(256,256),(256,128),(128,128),(128,64),(64,64),(64,32),(32,32),(32,16),(16,16),(16,8),(8,8),(8,4),(4,4),(4,2),(2,2)]
+
+def batch_cost(in_deg,out_deg,num_neighbors):
+    # Upper bounds (no deduplication) on the nodes, edges and MB a sampled batch costs per seed: hop 1
+    # keeps min(in-degree,fan-out) in-edges of a seed; hop-2 nodes are reached along edges, so their
+    # in-degree is weighted by out-degree. Per node: fp32 inputs (with the VAT perturbation and its
+    # gradient) and encoder activations; per edge: index, type and the two layers' messages.
+    f1,f2 = num_neighbors
+    m1 = in_deg.clamp(max=f1).mean().item()
+    m2 = ((out_deg*in_deg.clamp(max=f2)).sum()/out_deg.sum().clamp(min=1)).item()
+    nodes,edges = 1+m1+m1*m2,m1+m1*m2
+    node_bytes = 4*3*(args.text_input_size+args.meta_input_size)+4*8*args.hidden_size
+    edge_bytes = 8*3+4*4*args.hidden_size
+    return nodes,edges,(nodes*node_bytes+edges*edge_bytes)/2**20
+
+def loader_settings(dataset,num_seeds):
+    """(batch_size, num_neighbors) of a NeighborLoader over num_seeds seed nodes of dataset. Without a
+    budget: --batch_size (512 when unset) and [256,256]. With --budget_nodes/--budget_edges/--budget_mb:
+    the widest fan-out that fits --batch_size seeds (512 when unset) in the budget, from the degree
+    statistics; without --batch_size the seed count then grows to fill the budget."""
+    budgets = [(args.budget_nodes,0),(args.budget_edges,1),(args.budget_mb,2)]
+    budgets = [(budget,i) for budget,i in budgets if budget is not None]
+    target = args.batch_size or 512
+    if not budgets:
+        return target,[256,256]
+    edge_index = dataset.edge_index
+    in_deg = torch.bincount(edge_index[1],minlength=dataset.num_nodes).double()
+    out_deg = torch.bincount(edge_index[0],minlength=dataset.num_nodes).double()
+    for num_neighbors in FAN_OUTS:
+        cost = batch_cost(in_deg,out_deg,num_neighbors)
+        max_seeds = int(min(budget/cost[i] for budget,i in budgets))
+        if max_seeds >= target:
+            break
+    else:
+        print(f"Budget too small for {target} seeds even at fan-out {list(num_neighbors)}",file=stderr)
+    batch_size = args.batch_size or max(1,min(max_seeds,num_seeds))
+    nodes,edges,mb = (batch_size*c for c in cost)
+    print(f"Loader: {num_seeds} seeds, batch_size {batch_size}, num_neighbors {list(num_neighbors)}; "
+          f"per batch at most ~{nodes:.0f} nodes, {edges:.0f} edges, {mb:.0f} MB")
+    return batch_size,list(num_neighbors)
+
+def get_loader(dataset,input_nodes=None,with_text=True):
+    # with_text=False: batches carry no raw text rows, they are filled from a TextFeatureCache instead
+    if not with_text:
+        dataset = copy(dataset)
+        del dataset.text
+        if "text_scale" in dataset:
+            del dataset.text_scale
+    if get_world_size() > 1:
+        input_nodes = shard_nodes(dataset.num_nodes,input_nodes)
+    # The shuffle draws from a generator of the loader's own (seeded per exp by seed_loaders), not from
+    # the global RNG that dropout, VAT noise and SWD draw from
+    generator = torch.Generator()
+    if args.batching == "cluster":
+        return ClusterLoader(dataset,input_nodes,args.parts_per_batch,generator=generator)
+    elif args.batching != "neighbor":
+        raise KeyError(args.batching)
+    if input_nodes is None:
+        num_seeds = dataset.num_nodes
+    else:
+        num_seeds = int(input_nodes.sum()) if input_nodes.dtype == torch.bool else input_nodes.shape[0]
+    batch_size,num_neighbors = loader_settings(dataset,num_seeds)
+    return NeighborLoader(dataset,num_neighbors=num_neighbors,batch_size=batch_size,shuffle=True,input_nodes=input_nodes,is_sorted=args.csc_cache,
+                          generator=generator)
+
+class TextFeatureCache:
+    """text_encoder outputs (before its output dropout) for the nodes of a dataset. A row is encoded the first
+    time it is gathered and kept until the encoder's parameters are modified (tracked through their in-place
+    version counters, plus an optional tag such as EMA.num_updates for parameters re-pointed into a flat
+    buffer), so a sampled evaluation after each EMA update encodes only the rows its batches touch."""
+    def __init__(self,dataset,chunk_size):
+        self.text = dataset.text
+        self.text_scale = dataset.text_scale if "text_scale" in dataset else None
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.encoder = None
+        self.version = None
+        self.table = None
+        self.valid = None
+
+    def _sync(self,encoder,tag):
+        version = (tag,)+tuple(param._version for param in encoder.parameters())
+        if encoder is not self.encoder or version != self.version:
+            # a new table, so one returned by get() before stays as it was
+            self.table = None
+            self.valid = torch.zeros(self.text.shape[0],dtype=torch.bool)
+            self.encoder,self.version = encoder,version
+
+    def _encode(self,encoder,rows):
+        for chunk_rows in rows.split(self.chunk_size):
+            chunk = self.text[chunk_rows].to(args.device)
+            scale = None if self.text_scale is None else self.text_scale[chunk_rows]
+            feature = encoder.project(dequantize_text(chunk,scale))
+            if self.table is None:
+                self.table = feature.new_empty((self.text.shape[0],feature.shape[1]))
+            self.table[chunk_rows.to(self.table.device)] = feature
+        self.valid[rows] = True
+
+    @torch.no_grad()
+    def get(self,encoder,tag=None):
+        # The whole table, e.g. for a layer-wise pass over every node
+        with self.lock:
+            self._sync(encoder,tag)
+            missing = (~self.valid).nonzero().view(-1)
+            if missing.numel():
+                self._encode(encoder,missing)
+            return self.table
+
+    @torch.no_grad()
+    def gather(self,encoder,n_id,tag=None):
+        with self.lock:
+            self._sync(encoder,tag)
+            n_id = n_id.cpu()
+            missing = n_id[~self.valid[n_id]].unique()
+            if missing.numel():
+                self._encode(encoder,missing)
+            return self.table[n_id.to(self.table.device)]
+
+def prepare_batch(batch,text_cache=None,text_encoder=None,tag=None):
+    # Text rows cross to the device in their stored dtype and are dequantized there
+    if text_cache is None:
+        batch = batch.to(args.device)
+        if "text_scale" in batch:
+            batch.text = dequantize_text(batch.text,batch.text_scale)
+            del batch.text_scale
+        elif batch.text.dtype != torch.float32:
+            batch.text = dequantize_text(batch.text)
+        return batch
+    text = text_cache.gather(text_encoder,batch.n_id,tag)
+    batch = batch.to(args.device)
+    batch.text = text
+    batch.text_encoded = True
+    return batch
+
+def cycle_batches(loader,text_cache=None,text_encoder=None):
+    while True:
+        empty = True
+        for batch in loader:
+            empty = False
+            yield prepare_batch(batch,text_cache,text_encoder)
+        if empty: # would otherwise spin forever without yielding
+            raise ValueError("loader yielded no batches (no seed nodes?)")
+
+class BatchPrefetcher:
+    """Cycles over a loader in a background thread, keeping up to `depth` prepared batches ready."""
+    def __init__(self,loader,depth,text_cache=None,text_encoder=None):
+        self.loader = loader
+        self.text_cache = text_cache
+        self.text_encoder = text_encoder
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+    def _put(self,item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                empty = True
+                for batch in self.loader:
+                    empty = False
+                    if not self._put(prepare_batch(batch,self.text_cache,self.text_encoder)):
+                        return
+                if empty:
+                    raise ValueError("loader yielded no batches (no seed nodes?)")
+        except Exception as err:
+            self._put(err)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if isinstance(item,Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+class PhaseProfiler:
+    """Per-iteration wall time of the named phases of a training iteration, plus batch sizes and peak
+    memory, appended as one record per iteration to a .jsonl or .csv file. Without a path every
+    phase() is a no-op context. With trace_dir, iterations [trace_start, trace_start+trace_steps)
+    are also recorded with torch.profiler and exported as a Chrome trace."""
+    PHASES = ("sample_src","sample_tgt","forward","swd","cls","entropy","vat","vat_src","vat_tgt","backward","allreduce","step","ema","test")
+    EXTRA = ("seed","src_nodes","src_edges","tgt_nodes","tgt_edges","peak_mem_mb")
+
+    def __init__(self,path=None,sync=False,trace_dir=None,trace_start=10,trace_steps=5):
+        self.enabled = path is not None
+        self.path = path
+        self.sync = sync and torch.cuda.is_available()
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace = None
+        self.times = {}
+        self.file = None
+        self.writer = None
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def _phase(self,name):
+        self._sync()
+        start = time.perf_counter()
+        with (torch.profiler.record_function(name) if self.trace is not None else contextlib.nullcontext()):
+            yield
+        self._sync()
+        self.times[name] = self.times.get(name,0.)+time.perf_counter()-start
+
+    def phase(self,name):
+        return self._phase(name) if self.enabled or self.trace is not None else contextlib.nullcontext()
+
+    def begin(self,t):
+        if self.trace_dir is not None and self.trace is None and t == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities,record_shapes=True,profile_memory=True)
+            self.trace.__enter__()
+
+    def _peak_memory(self):
+        if torch.cuda.is_available() and torch.device(args.device).type == "cuda":
+            peak = torch.cuda.max_memory_allocated(args.device)/2**20
+            torch.cuda.reset_peak_memory_stats(args.device)
+            return peak
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 # process peak RSS (KiB on Linux)
+        except ImportError:
+            return None
+
+    def step(self,t,**extra):
+        if self.trace is not None and t+1 >= self.trace_start+self.trace_steps:
+            self.trace.__exit__(None,None,None)
+            os.makedirs(self.trace_dir,exist_ok=True)
+            path = os.path.join(self.trace_dir,f"trace_t{self.trace_start}-{t}.json")
+            self.trace.export_chrome_trace(path)
+            print(get_time(),f"Profiler trace written to {path}")
+            self.trace = None
+            self.trace_dir = None # one window per run
+        if not self.enabled:
+            self.times.clear()
+            return
+        record = OrderedDict(t=t)
+        for name in self.PHASES:
+            record[f"{name}_ms"] = round(self.times[name]*1000,3) if name in self.times else None
+        record["total_ms"] = round(sum(self.times.values())*1000,3)
+        record.update((name,extra.get(name)) for name in self.EXTRA)
+        record["peak_mem_mb"] = self._peak_memory()
+        self.times.clear()
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+            self.file = open(self.path,"a",newline="")
+            if self.path.endswith(".csv"):
+                self.writer = csv.DictWriter(self.file,fieldnames=list(record.keys()))
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record)+"\n")
+        if t % args.train_report == 0:
+            self.file.flush()
+
+def batch_stats(prefix,batch):
+    return {f"{prefix}_nodes":int(batch.num_nodes),f"{prefix}_edges":int(batch.edge_index.shape[1])}
+
+profiler = PhaseProfiler(args.profile,args.profile_sync,args.profile_trace,args.profile_trace_start,args.profile_trace_steps)
 
 #################################################################################
+def _flatten_params(params):
+    # Re-point every parameter at a slice of one contiguous buffer so they can be updated in a single op
+    flat = torch.cat([param.detach().reshape(-1) for param in params])
+    offset = 0
+    for param in params:
+        param.data = flat[offset:offset+param.numel()].view_as(param)
+        offset += param.numel()
+    return flat
+
 class EMA(nn.Module):
-    def __init__(self,model:nn.Module, decay:float):
+    def __init__(self,model:nn.Module, decay:float, flat:bool=False):
         super().__init__()
         self.decay = decay
         self.model = model
         self.shadow = deepcopy(self.model)
         for param in self.shadow.parameters():
             param.detach_()
+
+        # Parameter/buffer pairs are matched once here instead of on every update
+        model_params = OrderedDict(self.model.named_parameters())
+        shadow_params = OrderedDict(self.shadow.named_parameters())
+        assert model_params.keys() == shadow_params.keys()
+        model_buffers = OrderedDict(self.model.named_buffers())
+        shadow_buffers = OrderedDict(self.shadow.named_buffers())
+        assert model_buffers.keys() == shadow_buffers.keys()
+        self.model_params = list(model_params.values())
+        self.shadow_params = list(shadow_params.values())
+        self.model_buffers = list(model_buffers.values())
+        self.shadow_buffers = list(shadow_buffers.values())
+
+        self.shadow_forward = None
+        self.num_updates = 0
+        self.flat = flat
+        if self.flat:
+            self.flat_model = _flatten_params(self.model_params)
+            self.flat_shadow = _flatten_params(self.shadow_params)
     
     @torch.no_grad()
     def update(self):
         if not self.training:
             print("EMA update should only be called during training", file=stderr, flush=True)
             return
-        
-        model_params = OrderedDict(self.model.named_parameters())
-        shadow_params = OrderedDict(self.shadow.named_parameters())
-        assert model_params.keys() == shadow_params.keys()
 
-        for name,param in model_params.items():
-            shadow_params[name].sub_((1.-self.decay)*(shadow_params[name]-param))
-        
-        model_buffers = OrderedDict(self.model.named_buffers())
-        shadow_buffers = OrderedDict(self.shadow.named_buffers())
-        assert model_buffers.keys() == shadow_buffers.keys()
+        # shadow -= (1-decay)*(shadow-param)  ==  shadow.lerp_(param, 1-decay)
+        if self.flat:
+            self.flat_shadow.lerp_(self.flat_model,1.-self.decay)
+        elif hasattr(torch,"_foreach_lerp_"):
+            torch._foreach_lerp_(self.shadow_params,self.model_params,1.-self.decay)
+        else:
+            torch._foreach_mul_(self.shadow_params,self.decay)
+            torch._foreach_add_(self.shadow_params,self.model_params,alpha=1.-self.decay)
+
+        for shadow_buffer,buffer in zip(self.shadow_buffers,self.model_buffers):
+            shadow_buffer.copy_(buffer)
+        self.num_updates += 1
+
+    def compile_shadow(self, **kwargs):
+        # A compiled function rather than a submodule, so state_dict keys are unchanged
+        self.shadow_forward = torch.compile(self.shadow.forward, **kwargs)
 
-        for name,buffer in model_buffers.items():
-            shadow_buffers[name].copy_(buffer)
+    @property
+    def module(self):
+        return self.model if self.training else self.shadow
 
-    def forward(self, inputs):
+    def forward(self, inputs, **kwargs):
         if self.training:
-            return self.model(inputs)
+            return self.model(inputs, **kwargs)
+        elif self.shadow_forward is not None:
+            return self.shadow_forward(inputs, **kwargs)
         else:
-            return self.shadow(inputs)
+            return self.shadow(inputs, **kwargs)
 #################################################################################
 
 class RGCN_Encoder(nn.Module):
@@ -136,12 +734,50 @@ class RGCN_Encoder(nn.Module):
         self.relu = nn.LeakyReLU()
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self,x,edge_index,edge_type):
+    def forward(self,x,edge_index,edge_type,num_sampled_nodes=None,num_sampled_edges=None):
+        graph_feature = torch.cat(x,dim=1) if isinstance(x,(list,tuple)) else x
+        if num_sampled_nodes is None:
+            graph_feature = self.gcn1(graph_feature,edge_index,edge_type) 
+            graph_feature = self.dropout(self.relu(graph_feature))
+            graph_feature = self.gcn2(graph_feature,edge_index,edge_type)
+            graph_feature = self.dropout(self.relu(graph_feature))
+            return graph_feature
+        # Trimmed: nodes and edges of a sampled batch are ordered hop by hop, so layer i only has to
+        # produce the rows within len(convs)-1-i hops of the seeds, from the edges pointing at them.
+        # The output holds the seed rows only.
+        convs = (self.gcn1,self.gcn2)
+        for i,conv in enumerate(convs):
+            num_dst = sum(num_sampled_nodes[:len(convs)-i])
+            num_edges = sum(num_sampled_edges[:len(convs)-i])
+            graph_feature = conv((graph_feature,graph_feature[:num_dst]),edge_index[:,:num_edges],edge_type[:num_edges])
+            graph_feature = self.dropout(self.relu(graph_feature))
+        return graph_feature
+
+    @torch.no_grad()
+    def inference(self,x,edge_index,edge_type,chunk_size,is_sorted=False):
+        # Layer-wise over the whole graph: every node is computed once per layer, in chunks of
+        # destination nodes, instead of once per sampled subgraph it appears in. is_sorted: the edges
+        # are already ordered by destination (--csc_cache), so the argsort is skipped.
         graph_feature = torch.cat(x,dim=1)
-        graph_feature = self.gcn1(graph_feature,edge_index,edge_type) 
-        graph_feature = self.dropout(self.relu(graph_feature))
-        graph_feature = self.gcn2(graph_feature,edge_index,edge_type)
-        graph_feature = self.dropout(self.relu(graph_feature))
+        num_nodes = graph_feature.shape[0]
+        if not is_sorted:
+            perm = edge_index[1].argsort()
+            edge_index,edge_type = edge_index[:,perm],edge_type[perm]
+        bounds = torch.arange(0,num_nodes+chunk_size,chunk_size,device=edge_index.device).clamp(max=num_nodes)
+        ptr = torch.searchsorted(edge_index[1],bounds).tolist()
+        bounds = bounds.tolist()
+        for conv in (self.gcn1,self.gcn2):
+            out = []
+            for i in range(len(bounds)-1):
+                start,end = bounds[i],bounds[i+1]
+                if start == end:
+                    continue
+                sub_edge_index = edge_index[:,ptr[i]:ptr[i+1]].to(graph_feature.device)
+                sub_edge_index = torch.stack([sub_edge_index[0],sub_edge_index[1]-start])
+                sub_edge_type = edge_type[ptr[i]:ptr[i+1]].to(graph_feature.device)
+                h = conv((graph_feature,graph_feature[start:end]),sub_edge_index,sub_edge_type)
+                out.append(self.dropout(self.relu(h)))
+            graph_feature = torch.cat(out)
         return graph_feature
 
 ##############################################################################
@@ -153,13 +789,15 @@ class MLP_2L(nn.Module):
         self.relu = nn.LeakyReLU()
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self,x):
+    def project(self,x):
         feature = self.linear1(x)
         feature = self.relu(feature)
         feature = self.linear2(feature)
         feature = self.relu(feature)
-        feature = self.dropout(feature)
         return feature
+
+    def forward(self,x):
+        return self.dropout(self.project(x))
 ##############################################################################################
 class ABot_Feature_Generator(nn.Module):
     def __init__(self,hidden_size,text_input_size,meta_input_size,dropout,num_relations,transformer_att_head):
@@ -171,27 +809,57 @@ class ABot_Feature_Generator(nn.Module):
         self.TRM = torch.nn.MultiheadAttention(hidden_size,transformer_att_head)
         self.con_linear = nn.Linear(3*3,hidden_size)
 
-    def forward(self,input):
+    def forward(self,input,text_encoded=False,num_sampled_nodes=None,num_sampled_edges=None):
+        # text_encoded: x[1] already holds text_encoder.project outputs (see TextFeatureCache)
+        # num_sampled_nodes/edges: per-hop counts of a sampled batch; the graph encoder is trimmed
+        # layer by layer and only the seed rows are returned
         x,edge_index,edge_type = input
         meta,text = x[0],x[1]
         #description [batch_size,token_len,768]
 
         meta_feature = self.meta_encoder(meta)
-        text_feature = self.text_encoder(text)
+        text_feature = self.text_encoder.dropout(text) if text_encoded else self.text_encoder(text)
 
-        graph_feature = self.graph_encoder([meta_feature.detach().clone(),text_feature.detach().clone()],edge_index,edge_type)
+        graph_feature = self.graph_encoder(torch.cat([meta_feature,text_feature],dim=1).detach(),edge_index,edge_type,
+                                           num_sampled_nodes,num_sampled_edges)
+        if num_sampled_nodes is not None:
+            num_seeds = num_sampled_nodes[0]
+            text_feature,meta_feature = text_feature[:num_seeds],meta_feature[:num_seeds]
+        return self.fuse(graph_feature,text_feature,meta_feature)
 
-
-        feature = torch.stack((graph_feature,text_feature,meta_feature),0) #[3,batch_size,hidden_size]
-        feature,att_w = self.TRM(feature,feature,feature)
-        graph_feature,text_feature,meta_feature = torch.split(feature,1)
-        graph_feature = graph_feature.squeeze(0)
-        text_feature = text_feature.squeeze(0)
-        meta_feature = meta_feature.squeeze(0)
-
-        feature_con = att_w.view(att_w.shape[0],3*3)
+    @torch.no_grad()
+    def inference(self,meta,text,edge_index,edge_type,chunk_size,device,text_feature=None,is_sorted=False,text_scale=None):
+        # Encoder outputs for every node of the graph, see RGCN_Encoder.inference; text_scale is the
+        # per-row scale of int8 text
+        meta_feature = torch.cat([self.meta_encoder(chunk.to(device)) for chunk in meta.split(chunk_size)])
+        if text_feature is None:
+            scales = [None]*len(text.split(chunk_size)) if text_scale is None else text_scale.split(chunk_size)
+            text_feature = torch.cat([self.text_encoder(dequantize_text(chunk.to(device),scale))
+                                      for chunk,scale in zip(text.split(chunk_size),scales)])
+        graph_feature = self.graph_encoder.inference([meta_feature,text_feature],edge_index,edge_type,chunk_size,is_sorted)
+        return graph_feature,text_feature,meta_feature
+
+    def token_attention(self,feature):
+        # Same math as self.TRM(feature,feature,feature) over the 3 tokens (graph,text,meta),
+        # batched over [batch_size,3,hidden_size] with the TRM weights; att_w is averaged over heads
+        batch_size,num_tokens,hidden_size = feature.shape
+        num_heads = self.TRM.num_heads
+        head_dim = hidden_size//num_heads
+        qkv = F.linear(feature,self.TRM.in_proj_weight,self.TRM.in_proj_bias)
+        qkv = qkv.view(batch_size,num_tokens,3,num_heads,head_dim).permute(2,0,3,1,4) #[3,batch_size,heads,3,head_dim]
+        q,k,v = qkv[0],qkv[1],qkv[2]
+        att_w = torch.softmax(torch.matmul(q*head_dim**-0.5,k.transpose(-2,-1)),dim=-1) #[batch_size,heads,3,3]
+        feature = torch.matmul(att_w,v).transpose(1,2).reshape(batch_size,num_tokens,hidden_size)
+        feature = self.TRM.out_proj(feature)
+        return feature,att_w.mean(dim=1)
+
+    def fuse(self,graph_feature,text_feature,meta_feature):
+        feature = torch.stack((graph_feature,text_feature,meta_feature),1) #[batch_size,3,hidden_size]
+        feature,att_w = self.token_attention(feature)
+
+        feature_con = att_w.reshape(att_w.shape[0],3*3)
         feature_con = self.con_linear(feature_con)
-        final_feature = torch.cat([graph_feature,text_feature,meta_feature,feature_con],dim=1)
+        final_feature = torch.cat([feature.reshape(feature.shape[0],-1),feature_con],dim=1) #[graph,text,meta,con]
         return final_feature
     
 
@@ -217,15 +885,50 @@ class ABot_Classifier(nn.Module):
 
 # sliced wasserstein computation use
 def get_theta(embedding_dim, num_samples=50):
-    theta = [w / np.sqrt((w ** 2).sum())
-             for w in np.random.normal(size=(num_samples, embedding_dim))]
-    theta = np.asarray(theta)
-    return torch.from_numpy(theta).type(torch.FloatTensor).to(args.device)
+    theta = torch.randn(num_samples, embedding_dim, device=args.device)
+    return theta / theta.norm(dim=1, keepdim=True)
+
+
+class SWDProjections:
+    """Projection directions for sliced_wasserstein_distance, kept across iterations.
+    With pool_size > 0 they are rows drawn from one fixed pool; with refresh > 1 a draw is reused for that many steps."""
+    def __init__(self, embed_dim, num_projections=256, pool_size=0, refresh=1):
+        self.embed_dim = embed_dim
+        self.num_projections = num_projections
+        self.pool_size = pool_size
+        self.refresh = refresh
+        self.pool = None
+        self.theta = None
+
+    def __call__(self, step):
+        if self.theta is not None and step % self.refresh != 0:
+            return self.theta
+        if self.pool_size > 0:
+            if self.pool is None:
+                self.pool = get_theta(self.embed_dim, self.pool_size)
+                if get_world_size() > 1:
+                    dist.broadcast(self.pool, 0)
+            index = torch.randint(self.pool_size, (self.num_projections,), device=self.pool.device)
+            self.theta = self.pool[index]
+        else:
+            self.theta = get_theta(self.embed_dim, self.num_projections)
+        if get_world_size() > 1:
+            # Each rank draws from its own RNG stream; all of them project onto rank 0's directions,
+            # the ones save_checkpoint keeps
+            dist.broadcast(self.theta, 0)
+        return self.theta
+
+    def state_dict(self):
+        return {"pool": self.pool, "theta": self.theta}
+
+    def load_state_dict(self, state):
+        self.pool, self.theta = [None if v is None else v.to(args.device) for v in (state["pool"], state["theta"])]
 
 
-def sliced_wasserstein_distance(source_z, target_z, embed_dim, num_projections=256, p=1):
+def sliced_wasserstein_distance(source_z, target_z, embed_dim, num_projections=256, p=1, theta=None):
     # \theta is vector represents the projection directoin
-    theta = get_theta(embed_dim, num_projections) #[num_projections,embed_dim]
+    if theta is None:
+        theta = get_theta(embed_dim, num_projections) #[num_projections,embed_dim]
     proj_target = target_z.matmul(theta.transpose(0, 1))#[batch_size,num_projections]
     proj_source = source_z.matmul(theta.transpose(0, 1))
     w_distance = torch.sort(proj_target.transpose(0, 1), dim=1)[0] - torch.sort(proj_source.transpose(0, 1), dim=1)[0] 
@@ -268,16 +971,29 @@ class VATLoss(nn.Module):
         self.eps = eps
         self.ip = ip
 
-    def forward(self, model_f,model_c, x):
-        with torch.no_grad():
-            pred = model_f([[x.meta,x.text],x.edge_index,x.edge_type])
-            pred = pred[:x.batch_size]
-            pred = model_c(pred)
+    @staticmethod
+    def _distance(logp_hat,pred,weight):
+        if weight is None:
+            return F.kl_div(logp_hat, pred, reduction='batchmean')
+        return (F.kl_div(logp_hat, pred, reduction='none').sum(1)*weight).sum()
+
+    def forward(self, model_f,model_c, x, pred=None, weight=None):
+        """
+        :param pred: clean predictions of the x.batch_size seed rows; recomputed when None
+        :param weight: per-seed-row weights of the KL term; batch mean when None
+        """
+        if pred is None:
+            with torch.no_grad():
+                pred = forward_features(model_f,x)
+                pred = pred[:x.batch_size]
+                pred = model_c(pred)
+        else:
+            pred = pred.detach()
 
         # prepare random unit tensor
-        d_m = torch.rand(x.meta.shape).sub(0.5).to(x.meta.device)
+        d_m = torch.rand_like(x.meta).sub_(0.5)
         d_m = _l2_normalize(d_m)
-        d_t = torch.rand(x.text.shape).sub(0.5).to(x.text.device)
+        d_t = torch.rand_like(x.text).sub_(0.5)
         d_t = _l2_normalize(d_t)
 
         with _disable_tracking_bn_stats(model_f):
@@ -286,10 +1002,10 @@ class VATLoss(nn.Module):
                 for _ in range(self.ip):
                     d_m.requires_grad_()
                     d_t.requires_grad_()
-                    pred_hat = model_f([[x.meta+self.xi*d_m, x.text+self.xi*d_t],x.edge_index,x.edge_type])
+                    pred_hat = forward_features(model_f,x,x.meta+self.xi*d_m,x.text+self.xi*d_t)
                     pred_hat = pred_hat[:x.batch_size]
                     logp_hat = model_c(pred_hat)
-                    adv_distance = F.kl_div(logp_hat, pred, reduction='batchmean')
+                    adv_distance = self._distance(logp_hat,pred,weight)
                     adv_distance.backward()
                     d_m = _l2_normalize(d_m.grad)
                     d_t = _l2_normalize(d_t.grad)
@@ -299,15 +1015,104 @@ class VATLoss(nn.Module):
                 # calc LDS
                 r_adv_m = d_m * self.eps
                 r_adv_t = d_t * self.eps
-                pred_hat = model_f([[x.meta+r_adv_m,x.text+r_adv_t],x.edge_index,x.edge_type])
+                pred_hat = forward_features(model_f,x,x.meta+r_adv_m,x.text+r_adv_t)
                 pred_hat = pred_hat[:x.batch_size]
                 logp_hat = model_c(pred_hat)
-                lds = F.kl_div(logp_hat, pred, reduction='batchmean')
+                lds = self._distance(logp_hat,pred,weight)
 
         return lds
 
+class _PerDomain(nn.Module):
+    """model_c over the seed rows of merge_batches([src,tgt]), one domain block at a time, so BatchNorm
+    uses per-domain batch statistics as in the per-domain VAT passes (fast VAT)."""
+    def __init__(self,model_c,sizes):
+        super(_PerDomain,self).__init__()
+        self.model_c = model_c
+        self.sizes = sizes
+
+    def forward(self,input):
+        return torch.cat([self.model_c(block) for block in input.split(self.sizes)])
+
+def autocast(enabled=None):
+    # --amp: bf16 autocast around the feature generator only; features are returned in fp32, so the
+    # classifier, SWD and entropy terms stay in fp32
+    return torch.autocast(torch.device(args.device).type,dtype=torch.bfloat16,enabled=args.amp if enabled is None else enabled)
+
+_trim_warned = False
+
+def trim_counts(batch):
+    # --trim: the per-hop counts NeighborLoader attaches to a batch (torch_geometric >= 2.3); without
+    # them the batch is run untrimmed
+    global _trim_warned
+    if not args.trim:
+        return {}
+    num_sampled_nodes = getattr(batch,"num_sampled_nodes",None)
+    num_sampled_edges = getattr(batch,"num_sampled_edges",None)
+    if num_sampled_nodes is None or num_sampled_edges is None:
+        if not _trim_warned:
+            print("--trim: batches carry no num_sampled_nodes/num_sampled_edges, running untrimmed",file=stderr)
+            _trim_warned = True
+        return {}
+    return {"num_sampled_nodes":[int(n) for n in num_sampled_nodes],"num_sampled_edges":[int(n) for n in num_sampled_edges]}
+
+def forward_features(model_f,batch,meta=None,text=None,amp=None):
+    # meta/text default to the batch's own rows; text_encoded batches carry cached text_encoder outputs,
+    # so with --freeze_text VAT perturbs the encoded text instead of the raw 768-dim rows
+    meta = batch.meta if meta is None else meta
+    text = batch.text if text is None else text
+    with autocast(amp):
+        feature = model_f([[meta,text],batch.edge_index,batch.edge_type],text_encoded=getattr(batch,"text_encoded",False),**trim_counts(batch))
+    return feature.float()
+
+def merge_batches(batches):
+    """Disjoint union of sampled subgraphs laid out hop by hop: every batch's seed rows first, then every
+    batch's 1-hop rows and so on, with the edges in the same hop order. One forward pass covers all of
+    them, [:batch_size] still selects the seeds, and the per-hop counts of the union are kept so it
+    can be trimmed like a single batch. Batches without counts are split into seeds and the rest."""
+    hop_aware = all(getattr(batch,"num_sampled_nodes",None) is not None and getattr(batch,"num_sampled_edges",None) is not None
+                    for batch in batches)
+    if hop_aware:
+        node_hops = [[int(n) for n in batch.num_sampled_nodes] for batch in batches]
+        edge_hops = [[int(n) for n in batch.num_sampled_edges] for batch in batches]
+    else:
+        node_hops = [[batch.batch_size,batch.meta.shape[0]-batch.batch_size] for batch in batches]
+        edge_hops = [[batch.edge_index.shape[1]] for batch in batches]
+    num_node_hops,num_edge_hops = max(map(len,node_hops)),max(map(len,edge_hops))
+    node_hops = [hops+[0]*(num_node_hops-len(hops)) for hops in node_hops]
+    edge_hops = [hops+[0]*(num_edge_hops-len(hops)) for hops in edge_hops]
+    num_sampled_nodes = [sum(hops[i] for hops in node_hops) for i in range(num_node_hops)]
+    num_sampled_edges = [sum(hops[i] for hops in edge_hops) for i in range(num_edge_hops)]
+
+    offsets = np.cumsum([0]+num_sampled_nodes[:-1]).tolist()
+    positions = []
+    for batch,hops in zip(batches,node_hops):
+        pos = []
+        for i,n in enumerate(hops):
+            pos.append(torch.arange(offsets[i],offsets[i]+n))
+            offsets[i] += n
+        positions.append(torch.cat(pos).to(batch.meta.device))
+    num_nodes = sum(num_sampled_nodes)
+    meta = batches[0].meta.new_empty((num_nodes,)+tuple(batches[0].meta.shape[1:]))
+    text = batches[0].text.new_empty((num_nodes,)+tuple(batches[0].text.shape[1:]))
+    for batch,pos in zip(batches,positions):
+        meta.index_copy_(0,pos,batch.meta)
+        text.index_copy_(0,pos,batch.text)
+    edge_index,edge_type = [],[]
+    edge_ptrs = [np.cumsum([0]+hops).tolist() for hops in edge_hops]
+    for i in range(num_edge_hops):
+        for batch,pos,ptr in zip(batches,positions,edge_ptrs):
+            edge_index.append(pos[batch.edge_index[:,ptr[i]:ptr[i+1]]])
+            edge_type.append(batch.edge_type[ptr[i]:ptr[i+1]])
+    merged = Data(meta=meta,text=text,edge_index=torch.cat(edge_index,dim=1),edge_type=torch.cat(edge_type),
+                  batch_size=num_sampled_nodes[0],num_nodes=num_nodes)
+    if hop_aware:
+        merged.num_sampled_nodes = num_sampled_nodes
+        merged.num_sampled_edges = num_sampled_edges
+    merged.text_encoded = getattr(batches[0],"text_encoded",False)
+    return merged
+
 ################################################################################################
-def train_loop(src_batch,tgt_batch,model_f,model_c,criterion,optimizer_f,optimizer_c,ssa_ratio):
+def train_loop(src_batch,tgt_batch,model_f,model_c,criterion,optimizer_f,optimizer_c,ssa_ratio,swd_projections,vat_fn,step=0):
     model_f.train()
     model_c.train()
 
@@ -315,31 +1120,47 @@ def train_loop(src_batch,tgt_batch,model_f,model_c,criterion,optimizer_f,optimiz
 
     src_n_batch = src_batch.batch_size
     tgt_n_batch = tgt_batch.batch_size
-    src_feature = model_f([[src_batch.meta,src_batch.text],src_batch.edge_index,src_batch.edge_type])
-    tgt_feature = model_f([[tgt_batch.meta,tgt_batch.text],tgt_batch.edge_index,tgt_batch.edge_type])
+    with profiler.phase("forward"):
+        src_feature = forward_features(model_f,src_batch)
+        tgt_feature = forward_features(model_f,tgt_batch)
 
     dis_n = min(src_n_batch,tgt_n_batch) 
 
     # SWD domain loss
-    dis_loss = sliced_wasserstein_distance(src_feature[:dis_n],tgt_feature[:dis_n],int(src_feature.shape[1]))
+    with profiler.phase("swd"):
+        dis_loss = sliced_wasserstein_distance(src_feature[:dis_n],tgt_feature[:dis_n],int(src_feature.shape[1]),theta=swd_projections(step))
 
-    src_feature = src_feature[:src_n_batch]
-    src_pred = model_c(src_feature)
-    src_label = src_batch.y[:src_n_batch]
+    with profiler.phase("cls"):
+        src_feature = src_feature[:src_n_batch]
+        src_pred = model_c(src_feature)
+        src_label = src_batch.y[:src_n_batch]
 
-    # Source Cross-Entropy Classification Loss
-    cls_loss = criterion(src_pred,src_label)*ssa_ratio
+        # Source Cross-Entropy Classification Loss
+        cls_loss = criterion(src_pred,src_label)*ssa_ratio
 
     # Conditional Entropy Loss
-    tgt_feature = tgt_feature[:tgt_n_batch]
-    tgt_pred = model_c(tgt_feature)
-    cet_loss = conditional_entropy_loss(tgt_pred)
+    with profiler.phase("entropy"):
+        tgt_feature = tgt_feature[:tgt_n_batch]
+        tgt_pred = model_c(tgt_feature)
+        cet_loss = conditional_entropy_loss(tgt_pred)
 
     # Virtual Adversarial Training (VAT)
-    vat_fn = VATLoss()
-    src_vat_loss = vat_fn(model_f,model_c,src_batch)*ssa_ratio
-    tgt_vat_loss = vat_fn(model_f,model_c,tgt_batch)
-    vat_loss = src_vat_loss+tgt_vat_loss
+    if step % args.vat_interval != 0:
+        vat_loss = torch.zeros((),device=src_pred.device)
+    elif args.fast_vat:
+        # One adversarial pass over both domains, reusing the clean predictions computed above;
+        # the weights reproduce src_vat_loss*ssa_ratio+tgt_vat_loss
+        with profiler.phase("vat"):
+            weight = torch.cat([src_pred.new_full((src_n_batch,),ssa_ratio/src_n_batch),
+                                tgt_pred.new_full((tgt_n_batch,),1./tgt_n_batch)])
+            vat_loss = vat_fn(model_f,_PerDomain(model_c,[src_n_batch,tgt_n_batch]),merge_batches([src_batch,tgt_batch]),torch.cat([src_pred,tgt_pred]),weight)
+    else:
+        with profiler.phase("vat_src"):
+            src_vat_loss = vat_fn(model_f,model_c,src_batch)*ssa_ratio
+        with profiler.phase("vat_tgt"):
+            tgt_vat_loss = vat_fn(model_f,model_c,tgt_batch)
+        vat_loss = src_vat_loss+tgt_vat_loss
+    vat_loss = vat_loss*args.vat_interval
 
     loss = cls_loss+dis_loss*args.lmd_dis+cet_loss*args.lmd_cet+vat_loss*args.lmd_vat
     # loss = cls_loss
@@ -352,99 +1173,288 @@ def train_loop(src_batch,tgt_batch,model_f,model_c,criterion,optimizer_f,optimiz
 
     optimizer_f.zero_grad()
     optimizer_c.zero_grad()
-    loss.backward()
-    optimizer_c.step()
-    optimizer_f.step()
+    with profiler.phase("backward"):
+        loss.backward()
+    if get_world_size() > 1:
+        with profiler.phase("allreduce"):
+            all_reduce_grads(model_f,model_c)
+    with profiler.phase("step"):
+        optimizer_c.step()
+        optimizer_f.step()
 
     return train_loss
 
 
-def test_loop(dataloader,model_f,model_c,criterion):
+class FullGraphLoader:
+    """Sampling-free replacement for the test NeighborLoader: one layer-wise pass over the whole graph,
+    then the rows in input_nodes are classified chunk by chunk."""
+    def __init__(self,dataset,input_nodes,chunk_size):
+        self.dataset = dataset
+        self.index = input_nodes.nonzero().view(-1) if input_nodes.dtype == torch.bool else input_nodes
+        if get_world_size() > 1:
+            # every rank runs the layer-wise pass but classifies only its shard
+            self.index = shard_nodes(dataset.num_nodes,self.index)
+        self.chunk_size = chunk_size
+        self.text_cache = TextFeatureCache(dataset,chunk_size)
+
+    def __len__(self):
+        return (self.index.shape[0]+self.chunk_size-1)//self.chunk_size
+
+    def predict(self,model_f,model_c,text_cache=None,parity=False):
+        # Yields (pred, label, fp32 reference pred or None), see predict_batches
+        data = self.dataset
+        model = model_f.module if isinstance(model_f,EMA) else model_f
+        text_cache = self.text_cache if text_cache is None else text_cache
+        text_feature = text_cache.get(model.text_encoder,getattr(model_f,"num_updates",None))
+        runs = []
+        for amp in ([None,False] if parity else [None]):
+            with autocast(amp):
+                features = model.inference(data.meta,data.text,data.edge_index,data.edge_type,self.chunk_size,args.device,text_feature,
+                                           is_sorted=args.csc_cache,text_scale=data.text_scale if "text_scale" in data else None)
+            runs.append((amp,[feature.float() for feature in features]))
+        for index in self.index.split(self.chunk_size):
+            rows = index.to(text_feature.device)
+            preds = []
+            for amp,(graph_feature,text_feature,meta_feature) in runs:
+                with autocast(amp):
+                    feature = model.fuse(graph_feature[rows],text_feature[rows],meta_feature[rows])
+                preds.append(model_c(feature.float()))
+            yield preds[0],data.y[index.to(data.y.device)].to(args.device),preds[1] if parity else None
+
+def predict_batches(dataloader,model_f,model_c,text_cache=None,parity=False):
+    # Yields (pred, label, ref_pred) for the seed rows; with parity, ref_pred is the same batch in fp32
+    text_encoder = None if text_cache is None else (model_f.module if isinstance(model_f,EMA) else model_f).text_encoder
+    tag = getattr(model_f,"num_updates",None)
+    for batch in dataloader:
+        batch = prepare_batch(batch,text_cache,text_encoder,tag)
+        n_batch = batch.batch_size # 最后一个batch数量可能变化
+        pred = model_c(forward_features(model_f,batch)[:n_batch])
+        ref_pred = model_c(forward_features(model_f,batch,amp=False)[:n_batch]) if parity else None
+        yield pred[:n_batch],batch.y[:n_batch],ref_pred
+
+class ConfusionMeter:
+    """Streaming binary metrics kept on the device: the confusion counts, the summed loss and per-class
+    histograms of the bot probability (AUC over num_bins bins, ties within a bin counted as half).
+    compute() is the only host sync; under DDP it first sums the counts of every rank (disjoint shards)."""
+    def __init__(self,device,num_bins=1000):
+        self.num_bins = num_bins
+        self.confusion = torch.zeros(4,dtype=torch.long,device=device) #[tn,fp,fn,tp]
+        self.hist = torch.zeros(2*num_bins,dtype=torch.long,device=device)
+        self.loss = torch.zeros((),dtype=torch.float64,device=device)
+
+    def update(self,pred,label,loss=None):
+        label = label.long()
+        self.confusion += torch.bincount(label*2+pred.argmax(1),minlength=4)
+        bins = (pred[:,1].float()*self.num_bins).long().clamp_(0,self.num_bins-1)
+        self.hist += torch.bincount(label*self.num_bins+bins,minlength=2*self.num_bins)
+        if loss is not None:
+            self.loss += loss.detach().double()*label.shape[0]
+
+    def compute(self):
+        if get_world_size() > 1:
+            for tensor in (self.confusion,self.hist,self.loss):
+                dist.all_reduce(tensor)
+        values = torch.cat([self.confusion.double(),self.hist.double(),self.loss.view(1)]).cpu().numpy()
+        tn,fp,fn,tp = values[:4]
+        neg,pos = values[4:-1].reshape(2,self.num_bins)
+        n = tn+fp+fn+tp
+        num_pos,num_neg = pos.sum(),neg.sum()
+        if num_pos > 0 and num_neg > 0:
+            neg_below = np.cumsum(neg)-neg
+            auc = float((pos*(neg_below+0.5*neg)).sum()/(num_pos*num_neg))
+        else:
+            auc = float("nan")
+        return {"acc":float((tp+tn)/n) if n else 0.,
+                "precision":float(tp/(tp+fp)) if tp+fp else 0.,
+                "recall":float(tp/(tp+fn)) if tp+fn else 0.,
+                "f1":float(2*tp/(2*tp+fp+fn)) if tp+fp+fn else 0.,
+                "auc":auc,
+                "loss":float(values[-1]/n) if n else 0.,
+                "count":int(n)}
+
+def test_loop(dataloader,model_f,model_c,criterion,text_cache=None):
     model_f.eval()
     model_c.eval()
 
-    test_loss, correct, cnt = 0, 0, 0
-    prob_all = []
-    label_all = []
+    meter = ConfusionMeter(args.device)
 
-    with torch.no_grad():
-        for batch in dataloader:
-            n_batch = batch.batch_size # 最后一个batch数量可能变化
-            feature = model_f([[batch.meta,batch.text],batch.edge_index,batch.edge_type])
-            pred = model_c(feature)
+    parity = args.amp and args.amp_parity
+    ref_meter = ConfusionMeter(args.device) if parity else None
+    parity_agree = torch.zeros((),dtype=torch.long,device=args.device)
+    parity_diff = torch.zeros((),device=args.device)
 
-            pred = pred[:n_batch]
-            label = batch.y[:n_batch]
+    with torch.no_grad():
+        if isinstance(dataloader,FullGraphLoader):
+            outputs = dataloader.predict(model_f,model_c,text_cache,parity)
+        else:
+            outputs = predict_batches(dataloader,model_f,model_c,text_cache,parity)
+        for pred,label,ref_pred in outputs:
+            if ref_pred is not None:
+                ref_meter.update(ref_pred,label)
+                parity_agree += (ref_pred.argmax(1) == pred.argmax(1)).sum()
+                parity_diff = torch.maximum(parity_diff,(ref_pred-pred).abs().max())
             loss = criterion(pred,label) 
-
-            label = label.detach().cpu()
-            pred = pred.detach().cpu()
-            test_loss += loss.item()*n_batch 
-            cnt+=n_batch
-            correct += (pred.argmax(1) == label).type(torch.float).sum().item()
-            prob_all.extend(np.argmax(pred,axis=1))
-            label_all.extend(label)
-
-    test_loss /= cnt
-    f1 = f1_score(label_all,prob_all)
-    acc = accuracy_score(label_all,prob_all)
-    rc = recall_score(label_all,prob_all)
-    ps = precision_score(label_all,prob_all)
-    print(f"Test Accuracy: {(100*acc):>0.2f}%, F1-Score: {(100*f1):>0.4f}%, Recall: {(100*rc):>0.4f}%, Precision: {(100*ps):>0.4f}%, Avg loss: {test_loss:>8f}")
+            meter.update(pred,label,loss)
+
+    if parity and get_world_size() > 1:
+        dist.all_reduce(parity_agree)
+        dist.all_reduce(parity_diff,op=dist.ReduceOp.MAX)
+    metrics = meter.compute()
+    acc,f1,rc,ps = metrics["acc"],metrics["f1"],metrics["recall"],metrics["precision"]
+    if parity:
+        ref = ref_meter.compute()
+        print(f"AMP parity: fp32 Accuracy {(100*ref['acc']):>0.2f}%, bf16/fp32 agreement {(100*parity_agree.item()/max(ref['count'],1)):>0.2f}%, max |dp| {parity_diff.item():>0.4f}")
+    print(f"Test Accuracy: {(100*acc):>0.2f}%, F1-Score: {(100*f1):>0.4f}%, Recall: {(100*rc):>0.4f}%, Precision: {(100*ps):>0.4f}%, AUC: {metrics['auc']:>0.4f}, Avg loss: {metrics['loss']:>8f}")
     return acc,f1,rc,ps
 
 
 def get_time():
     return str(time.strftime("[%Y-%m-%d %H:%M:%S]", time.localtime()))
 
+def save_model(ema_model_f,ema_model_c,path,meta_scale=None,meta_shift=None):
+    # EMA shadows plus what AdaBot-serve.py needs to rebuild them; meta_scale/meta_shift map the
+    # target's stored meta to the model input (None: used as stored)
+    os.makedirs(os.path.dirname(path) or ".",exist_ok=True)
+    torch.save({"model_f":ema_model_f.shadow.state_dict(),
+                "model_c":ema_model_c.shadow.state_dict(),
+                "config":{"hidden_size":args.hidden_size,
+                          "text_input_size":args.text_input_size,
+                          "meta_input_size":args.meta_input_size,
+                          "dropout":args.dropout,
+                          "num_relations":args.num_relations,
+                          "transformer_att_head":args.transformer_att_head,
+                          "activation":"leaky_relu"},
+                "meta_scale":meta_scale,
+                "meta_shift":meta_shift},path)
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed) # also seeds every CUDA device
+
+def seed_loaders(loaders,seed):
+    # One shuffle stream per training loader, derived from the exp seed
+    for k,loader in enumerate(loaders):
+        loader.generator.manual_seed(seed*len(loaders)+k)
+
+def get_rng_state(loaders=()):
+    return {"python":random.getstate(),
+            "numpy":np.random.get_state(),
+            "torch":torch.get_rng_state(),
+            "cuda":torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "loaders":[loader.generator.get_state() for loader in loaders]}
+
+def set_rng_state(state,loaders=()):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    for loader,loader_state in zip(loaders,state.get("loaders",[])):
+        loader.generator.set_state(loader_state)
+
+def atomic_save(obj,path):
+    # Written to a temporary file of this process next to the target and renamed over it, so a crash
+    # mid-write keeps the previous file and concurrent writers (sweep jobs) never see a partial one
+    os.makedirs(os.path.dirname(path) or ".",exist_ok=True)
+    fd,tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",prefix=os.path.basename(path)+".",suffix=".tmp")
+    try:
+        with os.fdopen(fd,"w" if path.endswith(".json") else "wb") as f:
+            if path.endswith(".json"):
+                json.dump(obj,f,indent=1)
+            else:
+                torch.save(obj,f)
+        os.replace(tmp_path,path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def save_checkpoint(path,t,seed,metrics,ema_model_f,ema_model_c,optimizer_f,optimizer_c,swd_projections,loaders):
+    # Under DDP the models are identical on every rank; the RNG states (one per rank) are not
+    rng = gather_objects(get_rng_state(loaders)) if get_world_size() > 1 else get_rng_state(loaders)
+    if get_rank() != 0:
+        return
+    atomic_save({"t":t,
+                 "seed":seed,
+                 "metrics":metrics,
+                 "model_f":ema_model_f.state_dict(), # model and EMA shadow
+                 "model_c":ema_model_c.state_dict(),
+                 "optimizer_f":optimizer_f.state_dict(),
+                 "optimizer_c":optimizer_c.state_dict(),
+                 "swd":swd_projections.state_dict(), # projection pool and the current draw
+                 "rng":rng},path)
+
+def load_checkpoint(path,ema_model_f,ema_model_c,optimizer_f,optimizer_c,swd_projections,loaders):
+    checkpoint = torch.load(path,map_location="cpu",weights_only=False)
+    ema_model_f.load_state_dict(checkpoint["model_f"])
+    ema_model_c.load_state_dict(checkpoint["model_c"])
+    optimizer_f.load_state_dict(checkpoint["optimizer_f"])
+    optimizer_c.load_state_dict(checkpoint["optimizer_c"])
+    if "swd" in checkpoint:
+        swd_projections.load_state_dict(checkpoint["swd"])
+    rng = checkpoint["rng"]
+    set_rng_state(rng[get_rank()%len(rng)] if isinstance(rng,list) else rng,loaders)
+    return checkpoint["t"],checkpoint["metrics"]
+
+def load_results(run_dir):
+    # {str(e): {"seed","metrics"}} of the finished exps of a pair
+    path = os.path.join(run_dir,"result.json") if run_dir else None
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["exps"]
+
+def run_exp(seed,src_dataset,tgt_dataset,src_loader,tgt_train_loader,tgt_test_loader,tgt_eval_text_cache,test_name,ckpt_path=None):
+    """One repeat of a (src,tgt) pair. With ckpt_path, the state is checkpointed every --ckpt_interval
+    iterations and a run interrupted mid-exp resumes from its last checkpoint; the loaders start a
+    fresh epoch on resume, from the restored RNG state."""
+    seed_everything(seed)
+    ini_model_f = ABot_Feature_Generator(args.hidden_size,args.text_input_size,args.meta_input_size,args.dropout,args.num_relations,args.transformer_att_head).to(args.device)
+    ini_model_c = ABot_Classifier(args.hidden_size,args.dropout).to(args.device)
+    if get_world_size() > 1:
+        # Same starting weights on every rank, then a sampling/dropout stream of its own
+        broadcast_module(ini_model_f)
+        broadcast_module(ini_model_c)
+        seed_everything(seed*get_world_size()+get_rank())
+    if args.freeze_text:
+        ini_model_f.text_encoder.requires_grad_(False)
+    ema_model_f = EMA(ini_model_f,args.ema_decay,args.ema_flat)
+    ema_model_c = EMA(ini_model_c,args.ema_decay,args.ema_flat)
+    if args.compile:
+        ema_model_f.compile_shadow(dynamic=True)
+        ema_model_c.compile_shadow(dynamic=True)
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer_f = torch.optim.Adam(ema_model_f.parameters(),lr=args.lr,weight_decay=args.L2_reg)
+    optimizer_c = torch.optim.Adam(ema_model_c.parameters(),lr=args.lr,weight_decay=args.L2_reg)
+    # Per exp, so each repeat draws its projections from its own seed
+    swd_projections = SWDProjections(args.hidden_size*4, 256, args.swd_pool, args.swd_refresh)
+    vat_fn = VATLoss()
 
-if __name__ == "__main__":
-    
-    print(args)
-        
-    acc = [0]*args.exp_times
-    f1 = [0]*args.exp_times
-    ps = [0]*args.exp_times
-    rc = [0]*args.exp_times
-    for e in range(args.exp_times):
-        print(get_time()+f"^^^^^^^^Source Dataset {args.src_data}, Target Dataset {args.tgt_data} Exp{e}^^^^^^^^")
-        src_dataset = get_Dataset(args.data_root_path,args.src_data)
-        src_loader = NeighborLoader(src_dataset,num_neighbors=[256,256],batch_size=args.batch_size,shuffle=True)
-        len_src = len(src_loader)
-        tgt_dataset = get_Dataset(args.data_root_path,args.tgt_data)
-        if args.meta_align:
-            print("Target Meta Data Aligning with Source Meta Data")
-            sm_mean = src_dataset.meta.mean(axis=0)
-            sm_std = src_dataset.meta.std(axis=0)
-            src_dataset.meta = (src_dataset.meta-sm_mean)/sm_std
-            tgt_dataset.meta = (tgt_dataset.meta-sm_mean)/sm_std
-        else:
-            src_dataset.meta = (src_dataset.meta-src_dataset.meta.mean(axis=0))/src_dataset.meta.std(axis=0)
-            tgt_dataset.meta = (tgt_dataset.meta-tgt_dataset.meta.mean(axis=0))/tgt_dataset.meta.std(axis=0)
+    seed_loaders([src_loader,tgt_train_loader],seed)
+    start,metrics = 0,None
+    if ckpt_path is not None and os.path.exists(ckpt_path):
+        start,metrics = load_checkpoint(ckpt_path,ema_model_f,ema_model_c,optimizer_f,optimizer_c,swd_projections,[src_loader,tgt_train_loader])
+        print(get_time(),f"Resumed from {ckpt_path} at iteration {start}")
 
-        # Tgt Dataset Split
-        print(f"Test Num {tgt_dataset.test_mask.sum()} Train Num {tgt_dataset.train_mask.sum()}")
-        tgt_train_loader = NeighborLoader(tgt_dataset,num_neighbors=[256,256],batch_size=args.batch_size,shuffle=True,input_nodes=tgt_dataset.train_mask)
-        tgt_test_loader = NeighborLoader(tgt_dataset,num_neighbors=[256,256],batch_size=args.batch_size,shuffle=True,input_nodes=tgt_dataset.test_mask)        
-        len_tgt = len(tgt_train_loader)
-
-        ini_model_f = ABot_Feature_Generator(args.hidden_size,args.text_input_size,args.meta_input_size,args.dropout,args.num_relations,args.transformer_att_head).to(args.device)
-        ini_model_c = ABot_Classifier(args.hidden_size,args.dropout).to(args.device)
-        ema_model_f = EMA(ini_model_f,args.ema_decay)
-        ema_model_c = EMA(ini_model_c,args.ema_decay)
-
-        criterion = nn.CrossEntropyLoss()
-        optimizer_f = torch.optim.Adam(ema_model_f.parameters(),lr=args.lr,weight_decay=args.L2_reg)
-        optimizer_c = torch.optim.Adam(ema_model_c.parameters(),lr=args.lr,weight_decay=args.L2_reg)
-
-        for t in range(args.iterations):
-            if t % len_src == 0: 
-                itr_src = iter(src_loader)
-            if t % len_tgt == 0:
-                itr_tgt = iter(tgt_train_loader)
-            
-            scr_batch = next(itr_src)
-            tgt_batch = next(itr_tgt)
+    if args.freeze_text:
+        src_text = (TextFeatureCache(src_dataset,args.infer_chunk),ini_model_f.text_encoder)
+        tgt_text = (TextFeatureCache(tgt_dataset,args.infer_chunk),ini_model_f.text_encoder)
+    else:
+        src_text = tgt_text = (None,None)
+    if args.prefetch > 0:
+        itr_src = BatchPrefetcher(src_loader,args.prefetch,*src_text)
+        itr_tgt = BatchPrefetcher(tgt_train_loader,args.prefetch,*tgt_text)
+    else:
+        itr_src = cycle_batches(src_loader,*src_text)
+        itr_tgt = cycle_batches(tgt_train_loader,*tgt_text)
+    try:
+        for t in range(start,args.iterations):
+            profiler.begin(t)
+            with profiler.phase("sample_src"):
+                scr_batch = next(itr_src)
+            with profiler.phase("sample_tgt"):
+                tgt_batch = next(itr_tgt)
 
             if not args.ssa:
                 ssa_ratio = 1.0
@@ -458,35 +1468,124 @@ if __name__ == "__main__":
                 else:
                     raise KeyError
             
-            train_loss = train_loop(scr_batch, tgt_batch, ema_model_f,ema_model_c,criterion, optimizer_f,optimizer_c,ssa_ratio)
+            train_loss = train_loop(scr_batch, tgt_batch, ema_model_f,ema_model_c,criterion, optimizer_f,optimizer_c,ssa_ratio,swd_projections,vat_fn,t)
             if t % args.train_report == 0:
                 print(get_time(),f"Iteration {t}::Train loss {train_loss:>8f}")
             if (t+1) % args.ema_interval == 0:
-                ema_model_c.update()
-                ema_model_f.update()
+                with profiler.phase("ema"):
+                    if get_world_size() > 1:
+                        average_buffers(ema_model_c.model)
+                    ema_model_c.update()
+                    ema_model_f.update()
             if (t+1) % args.test_report == 0:
                 print(f"******Iteration-{t+1}******")
-                print(f"Test on Dataset {args.tgt_data} ######")
-                acc[e],f1[e],rc[e],ps[e]=test_loop(tgt_test_loader,ema_model_f,ema_model_c,criterion)
+                print(f"Test on {test_name} ######")
+                with profiler.phase("test"):
+                    metrics = [float(v) for v in test_loop(tgt_test_loader,ema_model_f,ema_model_c,criterion,tgt_eval_text_cache)]
+            profiler.step(t,seed=seed,**batch_stats("src",scr_batch),**batch_stats("tgt",tgt_batch))
+            if ckpt_path is not None and args.ckpt_interval > 0 and (t+1) % args.ckpt_interval == 0 and t+1 < args.iterations:
+                save_checkpoint(ckpt_path,t+1,seed,metrics,ema_model_f,ema_model_c,optimizer_f,optimizer_c,swd_projections,[src_loader,tgt_train_loader])
+    finally:
+        itr_src.close()
+        itr_tgt.close()
+    return metrics,ema_model_f,ema_model_c
+
+
+def main():
+    print(args)
+        
+    print(get_time()+f"^^^^^^^^Source Dataset {args.src_data}, Target Dataset {args.tgt_data}^^^^^^^^")
+    run_dir = os.path.join(args.ckpt_dir,f"{args.src_data}_to_{args.tgt_data}_seed{args.seed}") if args.ckpt_dir else None
+    results = load_results(run_dir)
+    if all(str(e) in results for e in range(args.exp_times)):
+        print(f"All {args.exp_times} exps already done in {run_dir}, skipping")
+    else:
+        # Loaded, normalized and indexed once; the repeats below only re-seed the model and sampler
+        src_dataset = get_Dataset(args.data_root_path,args.src_data)
+        tgt_dataset = get_Dataset(args.data_root_path,args.tgt_data)
+        if args.meta_align:
+            print("Target Meta Data Aligning with Source Meta Data")
+            sm_mean = src_dataset.meta.mean(axis=0)
+            sm_std = src_dataset.meta.std(axis=0)
+            src_dataset.meta = (src_dataset.meta-sm_mean)/sm_std
+            tgt_dataset.meta = (tgt_dataset.meta-sm_mean)/sm_std
+            meta_scale,meta_shift = 1/sm_std,-sm_mean/sm_std
+        else:
+            tm_mean = tgt_dataset.meta.mean(axis=0)
+            tm_std = tgt_dataset.meta.std(axis=0)
+            src_dataset.meta = (src_dataset.meta-src_dataset.meta.mean(axis=0))/src_dataset.meta.std(axis=0)
+            tgt_dataset.meta = (tgt_dataset.meta-tm_mean)/tm_std
+            meta_scale,meta_shift = 1/tm_std,-tm_mean/tm_std
+        src_loader = get_loader(src_dataset,with_text=not args.freeze_text)
 
-        # torch.save(model.state_dict(),save_path+f"model_com{train_com}.pth")
+        # Tgt Dataset Split
+        print(f"Test Num {tgt_dataset.test_mask.sum()} Train Num {tgt_dataset.train_mask.sum()}")
+        tgt_train_loader = get_loader(tgt_dataset,tgt_dataset.train_mask,with_text=not args.freeze_text)
+        if args.full_graph_test:
+            tgt_test_loader = FullGraphLoader(tgt_dataset,tgt_dataset.test_mask,args.infer_chunk)
+        else:
+            tgt_test_loader = get_loader(tgt_dataset,tgt_dataset.test_mask,with_text=False)
+        # Evaluation always reads text features from a table (exact: no dropout in eval mode)
+        tgt_eval_text_cache = TextFeatureCache(tgt_dataset,args.infer_chunk)
+
+        for e in range(args.exp_times):
+            if str(e) in results:
+                print(get_time()+f"^^^^^^^^Source Dataset {args.src_data}, Target Dataset {args.tgt_data} Exp{e}^^^^^^^^ already done (seed {results[str(e)]['seed']})")
+                continue
+            seed = args.seed+e
+            print(get_time()+f"^^^^^^^^Source Dataset {args.src_data}, Target Dataset {args.tgt_data} Exp{e}^^^^^^^^ seed {seed}")
+            ckpt_path = os.path.join(run_dir,f"exp{e}.pt") if run_dir else None
+            metrics,ema_model_f,ema_model_c = run_exp(seed,src_dataset,tgt_dataset,src_loader,tgt_train_loader,tgt_test_loader,tgt_eval_text_cache,
+                                                      f"Dataset {args.tgt_data}",ckpt_path)
+
+            if args.save_path and get_rank() == 0:
+                save_model(ema_model_f,ema_model_c,os.path.join(args.save_path,f"model_{args.src_data}_to_{args.tgt_data}_exp{e}.pth"),meta_scale,meta_shift)
+            results[str(e)] = {"seed":seed,"metrics":metrics}
+            if run_dir and get_rank() == 0:
+                atomic_save({"src":args.src_data,"tgt":args.tgt_data,"exps":results},os.path.join(run_dir,"result.json"))
+                if os.path.exists(ckpt_path):
+                    os.remove(ckpt_path)
+            del ema_model_c
+            del ema_model_f
 
-        del ini_model_f
-        del ini_model_c
-        del ema_model_c
-        del ema_model_f
         del tgt_dataset
         del tgt_test_loader
         del tgt_train_loader
         del src_dataset
         del src_loader
-        del criterion
-        del optimizer_f
-        del optimizer_c
-    tmp_a = np.array(acc,dtype=np.float32)
-    tmp_f = np.array(f1,dtype=np.float32)
-    tmp_r = np.array(rc,dtype=np.float32)
-    tmp_p = np.array(ps,dtype=np.float32)
+
+    metrics = [results[str(e)]["metrics"] or [0,0,0,0] for e in range(args.exp_times)]
+    tmp_a = np.array([m[0] for m in metrics],dtype=np.float32)
+    tmp_f = np.array([m[1] for m in metrics],dtype=np.float32)
+    tmp_r = np.array([m[2] for m in metrics],dtype=np.float32)
+    tmp_p = np.array([m[3] for m in metrics],dtype=np.float32)
     print(f"@@@@@@ Source Dataset {args.src_data}, Target Dataset {args.tgt_data}: Mean ACC {(100*tmp_a.mean()):>0.2f}%, Std ACC {(100*tmp_a.std()):>0.2f}%; Mean F1 {100*tmp_f.mean():>0.4f}, Std F1 {100*tmp_f.std():>0.4f}; Mean RC {(100*tmp_r.mean()):>0.2f}%, Std RC {(100*tmp_r.std()):>0.2f}%; Mean PS {100*tmp_p.mean():>0.4f}, Std PS {100*tmp_p.std():>0.4f}")
 
-print("Done!")
+def ddp_worker(rank,world_size):
+    # One training process of a data-parallel run; only rank 0 prints and writes results
+    os.environ.setdefault("MASTER_ADDR","127.0.0.1")
+    os.environ.setdefault("MASTER_PORT",str(args.ddp_port))
+    dist.init_process_group(args.ddp_backend,rank=rank,world_size=world_size)
+    local_rank = int(os.environ.get("LOCAL_RANK",rank))
+    if args.device.startswith("cuda"):
+        args.device = f"cuda:{local_rank}"
+        torch.cuda.set_device(args.device)
+    if rank > 0:
+        global profiler
+        profiler = PhaseProfiler()
+        sys.stdout = open(os.devnull,"w")
+    print(f"DDP: {world_size} ranks, {args.ddp_backend} backend")
+    try:
+        main()
+    finally:
+        dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    if int(os.environ.get("WORLD_SIZE",1)) > 1: # launched by torchrun
+        ddp_worker(int(os.environ["RANK"]),int(os.environ["WORLD_SIZE"]))
+    elif args.ddp_world_size > 1:
+        mp.spawn(ddp_worker,args=(args.ddp_world_size,),nprocs=args.ddp_world_size)
+    else:
+        main()
+    print("Done!")
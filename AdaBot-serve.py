@@ -0,0 +1,646 @@
+import torch
+import numpy as np
+from torch import nn
+import torch.nn.functional as F
+from torch_geometric.nn import RGCNConv
+from torch_geometric.data import Data
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from adabot_pack import load_packed,quantize_text,dequantize_text
+
+###
+# Online bot scoring with a (model_f, model_c) pair saved by the training scripts (--save_path).
+# Requests are micro-batched: concurrent calls are merged into one sampled subgraph and one forward pass.
+###
+
+ACTIVATIONS = {"relu":nn.ReLU,"leaky_relu":nn.LeakyReLU}
+
+class RGCN_Encoder(nn.Module):
+    def __init__(self,hidden_size,num_relations,dropout,activation):
+        super(RGCN_Encoder,self).__init__()
+        self.gcn1 = RGCNConv(hidden_size*2,hidden_size,num_relations)
+        self.gcn2 = RGCNConv(hidden_size,hidden_size,num_relations)
+        self.relu = ACTIVATIONS[activation]()
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self,x,edge_index,edge_type):
+        graph_feature = torch.cat(x,dim=1) if isinstance(x,(list,tuple)) else x
+        graph_feature = self.gcn1(graph_feature,edge_index,edge_type)
+        graph_feature = self.dropout(self.relu(graph_feature))
+        graph_feature = self.gcn2(graph_feature,edge_index,edge_type)
+        graph_feature = self.dropout(self.relu(graph_feature))
+        return graph_feature
+
+class MLP_2L(nn.Module):
+    def __init__(self,input_size,hidden_size,output_size,dropout,activation):
+        super(MLP_2L,self).__init__()
+        self.linear1 = nn.Linear(input_size,hidden_size)
+        self.linear2 = nn.Linear(hidden_size,output_size)
+        self.relu = ACTIVATIONS[activation]()
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self,x):
+        feature = self.linear1(x)
+        feature = self.relu(feature)
+        feature = self.linear2(feature)
+        feature = self.relu(feature)
+        feature = self.dropout(feature)
+        return feature
+
+class ABot_Feature_Generator(nn.Module):
+    def __init__(self,hidden_size,text_input_size,meta_input_size,dropout,num_relations,transformer_att_head,activation):
+        super(ABot_Feature_Generator,self).__init__()
+        self.graph_encoder = RGCN_Encoder(hidden_size,num_relations,dropout,activation)
+        self.text_encoder = MLP_2L(text_input_size,hidden_size,hidden_size,dropout,activation)
+        self.meta_encoder = MLP_2L(meta_input_size,hidden_size,hidden_size,dropout,activation)
+        self.relu = ACTIVATIONS[activation]()
+        self.TRM = torch.nn.MultiheadAttention(hidden_size,transformer_att_head)
+        self.con_linear = nn.Linear(3*3,hidden_size)
+
+    def forward(self,input):
+        x,edge_index,edge_type = input
+        meta,text = x[0],x[1]
+
+        meta_feature = self.meta_encoder(meta)
+        text_feature = self.text_encoder(text)
+
+        graph_feature = self.graph_encoder(torch.cat([meta_feature,text_feature],dim=1).detach(),edge_index,edge_type)
+        return self.fuse(graph_feature,text_feature,meta_feature)
+
+    def token_attention(self,feature):
+        # Same math as self.TRM(feature,feature,feature) over the 3 tokens (graph,text,meta),
+        # batched over [batch_size,3,hidden_size] with the TRM weights; att_w is averaged over heads
+        batch_size,num_tokens,hidden_size = feature.shape
+        num_heads = self.TRM.num_heads
+        head_dim = hidden_size//num_heads
+        qkv = F.linear(feature,self.TRM.in_proj_weight,self.TRM.in_proj_bias)
+        qkv = qkv.view(batch_size,num_tokens,3,num_heads,head_dim).permute(2,0,3,1,4) #[3,batch_size,heads,3,head_dim]
+        q,k,v = qkv[0],qkv[1],qkv[2]
+        att_w = torch.softmax(torch.matmul(q*head_dim**-0.5,k.transpose(-2,-1)),dim=-1) #[batch_size,heads,3,3]
+        feature = torch.matmul(att_w,v).transpose(1,2).reshape(batch_size,num_tokens,hidden_size)
+        feature = self.TRM.out_proj(feature)
+        return feature,att_w.mean(dim=1)
+
+    def fuse(self,graph_feature,text_feature,meta_feature):
+        feature = torch.stack((graph_feature,text_feature,meta_feature),1) #[batch_size,3,hidden_size]
+        feature,att_w = self.token_attention(feature)
+
+        feature_con = att_w.reshape(att_w.shape[0],3*3)
+        feature_con = self.con_linear(feature_con)
+        final_feature = torch.cat([feature.reshape(feature.shape[0],-1),feature_con],dim=1) #[graph,text,meta,con]
+        return final_feature
+
+class ABot_Classifier(nn.Module):
+    def __init__(self,hidden_size,dropout,activation):
+        super(ABot_Classifier,self).__init__()
+        self.relu = ACTIVATIONS[activation]()
+        self.output_linear1 = nn.Linear(hidden_size*4,hidden_size)
+        self.output_linear2 = nn.Linear(hidden_size,2)
+        self.softmax = nn.Softmax(dim=1)
+        self.batch_norm = nn.BatchNorm1d(hidden_size)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self,input):
+        feature = input
+        final_feature = self.relu(self.output_linear1(feature))
+        final_feature = self.batch_norm(self.dropout(final_feature))
+        final_feature = self.output_linear2(final_feature)
+        prob = self.softmax(final_feature)
+        return prob
+
+def load_model(path,device):
+    checkpoint = torch.load(path,map_location="cpu")
+    config = checkpoint["config"]
+    model_f = ABot_Feature_Generator(config["hidden_size"],config["text_input_size"],config["meta_input_size"],config["dropout"],
+                                     config["num_relations"],config["transformer_att_head"],config["activation"])
+    model_c = ABot_Classifier(config["hidden_size"],config["dropout"],config["activation"])
+    model_f.load_state_dict(checkpoint["model_f"])
+    model_c.load_state_dict(checkpoint["model_c"])
+    return model_f.to(device).eval(),model_c.to(device).eval(),checkpoint
+
+################################################################################################
+def load_graph(data_root_path,com=None,name=None,packed=False):
+    # Returns meta, text, edge_index, edge_type, the external account ids (None: ids are node indices)
+    # and the per-row scale of int8 text (None: text is stored as floats)
+    if com is not None:
+        if packed:
+            _,fields = load_packed(data_root_path+f"com{com}.pack")
+        else:
+            fields = {key:torch.load(data_root_path+f"com{com}_{key}.pt",map_location="cpu")
+                      for key in ("text","meta","edge_index","edge_type")}
+            fields["edge_type"][fields["edge_type"]==12] = 1
+    else:
+        if packed:
+            _,fields = load_packed(os.path.join(data_root_path,name,"data.pack"))
+        else:
+            load = lambda key: torch.load(os.path.join(data_root_path,name,f"{key}.pt"),map_location="cpu")
+            fields = {"text":load("text"),"meta":load("meta"),"edge_index":load("egde_index"),"edge_type":load("egde_type")}
+            if os.path.exists(os.path.join(data_root_path,name,"id.pt")):
+                fields["id"] = load("id")
+    return fields["meta"].type(torch.float32),fields["text"],fields["edge_index"],fields["edge_type"],fields.get("id"),fields.get("text_scale")
+
+################################################################################################
+class GrowableTensor:
+    """Rows appended in place; capacity doubles so a stream of small appends is amortized O(1) per row."""
+    def __init__(self,row_shape,dtype,capacity=1024):
+        self.buffer = torch.empty((capacity,)+tuple(row_shape),dtype=dtype)
+        self.size = 0
+
+    @property
+    def data(self):
+        return self.buffer[:self.size]
+
+    def append(self,rows):
+        end = self.size+rows.shape[0]
+        if end > self.buffer.shape[0]:
+            buffer = self.buffer.new_empty((max(end,2*self.buffer.shape[0]),)+tuple(self.buffer.shape[1:]))
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.buffer[self.size:end] = rows.to(self.buffer.dtype)
+        self.size = end
+
+class FeatureTable:
+    """Per-node feature rows: the loaded (possibly memory-mapped) matrix followed by appended rows,
+    so new accounts never copy the loaded features."""
+    def __init__(self,base):
+        self.base = base
+        self.extra = GrowableTensor(base.shape[1:],base.dtype)
+
+    @property
+    def shape(self):
+        return (self.base.shape[0]+self.extra.size,)+tuple(self.base.shape[1:])
+
+    def __getitem__(self,index):
+        n = self.base.shape[0]
+        in_base = index < n
+        out = self.base.new_empty((index.shape[0],)+tuple(self.base.shape[1:]))
+        out[in_base] = self.base[index[in_base]]
+        out[~in_base] = self.extra.data[index[~in_base]-n]
+        return out
+
+    def __setitem__(self,index,rows):
+        n = self.base.shape[0]
+        in_base = index < n
+        rows = rows.to(self.base.dtype)
+        self.base[index[in_base]] = rows[in_base]
+        self.extra.data[index[~in_base]-n] = rows[~in_base]
+
+    def append(self,rows):
+        self.extra.append(rows)
+
+class GraphIndex:
+    """Incremental account graph used to sample the same kind of 2-hop neighborhoods the training
+    NeighborLoaders produce. Edges live in a CSC index built at load time plus an append-only delta
+    list; the delta is merged into the CSC index once it outgrows compact_ratio of it."""
+    def __init__(self,meta,text,edge_index,edge_type,ids=None,compact_ratio=0.25,text_scale=None):
+        self.lock = threading.RLock()
+        self.meta = FeatureTable(meta)
+        self.text = FeatureTable(text)
+        self.text_scale = None if text_scale is None else FeatureTable(text_scale)
+        self.id2index = None if ids is None else {int(i):n for n,i in enumerate(ids.tolist())}
+        self.compact_ratio = compact_ratio
+        self._build(edge_index,edge_type)
+
+    @property
+    def num_nodes(self):
+        return self.meta.shape[0]
+
+    @property
+    def num_edges(self):
+        return self.row.shape[0]+self.delta_src.size
+
+    def _build(self,edge_index,edge_type):
+        self.base_nodes = self.num_nodes
+        perm = (edge_index[1]*self.base_nodes+edge_index[0]).argsort()
+        self.row = edge_index[0,perm].contiguous()
+        self.col = edge_index[1,perm].contiguous()
+        self.edge_type = edge_type[perm].contiguous()
+        self.colptr = torch.zeros(self.base_nodes+1,dtype=torch.long)
+        self.colptr[1:] = torch.bincount(self.col,minlength=self.base_nodes).cumsum(0)
+        self.delta_src = GrowableTensor((),torch.long)
+        self.delta_dst = GrowableTensor((),torch.long)
+        self.delta_type = GrowableTensor((),self.edge_type.dtype)
+        self._csr = None
+
+    def compact(self):
+        """Merge the delta edges into the CSC index."""
+        with self.lock:
+            edge_index = torch.cat([torch.stack([self.row,self.col]),torch.stack([self.delta_src.data,self.delta_dst.data])],dim=1)
+            self._build(edge_index,torch.cat([self.edge_type,self.delta_type.data]))
+
+    def text_rows(self,index):
+        # Float32 text rows; reduced-precision / int8 storage is dequantized on gather
+        return dequantize_text(self.text[index],None if self.text_scale is None else self.text_scale[index])
+
+    def _store_text(self,text):
+        # Inverse of text_rows for rows written through add_accounts
+        if self.text_scale is None:
+            return text,None
+        return quantize_text(text,"int8")
+
+    def lookup(self,ids):
+        with self.lock:
+            if self.id2index is None:
+                index = torch.as_tensor(ids,dtype=torch.long)
+                if index.numel() and (index.min() < 0 or index.max() >= self.num_nodes):
+                    raise KeyError("unknown account id")
+                return index
+            try:
+                return torch.tensor([self.id2index[int(i)] for i in ids],dtype=torch.long)
+            except KeyError as err:
+                raise KeyError(f"unknown account id {err.args[0]}") from None
+
+    def add_accounts(self,ids,meta=None,text=None,edges=None):
+        """Add or update accounts. Unknown ids need meta and text; edges are (src_id, dst_id, edge_type).
+        Returns (nodes whose features were written, dst nodes of the new edges)."""
+        with self.lock:
+            if self.id2index is None:
+                self.id2index = {n:n for n in range(self.num_nodes)}
+            # First row of each unknown id: an id repeated within ids is one new account
+            new_rows,seen = [],set()
+            for n,i in enumerate(ids):
+                if int(i) not in self.id2index and int(i) not in seen:
+                    seen.add(int(i))
+                    new_rows.append(n)
+            if new_rows:
+                assert meta is not None and text is not None, "new accounts need meta and text features"
+                num_nodes = self.num_nodes
+                for k,n in enumerate(new_rows):
+                    self.id2index[int(ids[n])] = num_nodes+k
+                self.meta.append(meta[new_rows])
+                self.text.append(text[new_rows])
+                if self.text_scale is not None:
+                    self.text_scale.append(torch.ones(len(new_rows)))
+            index = self.lookup(ids)
+            if meta is not None:
+                self.meta[index] = meta
+            if text is not None:
+                text,scale = self._store_text(text)
+                self.text[index] = text
+                if scale is not None:
+                    self.text_scale[index] = scale
+            changed = index if meta is not None or text is not None else index[:0]
+            dst = torch.zeros(0,dtype=torch.long)
+            if edges:
+                src = self.lookup([e[0] for e in edges])
+                dst = self.lookup([e[1] for e in edges])
+                self.delta_src.append(src)
+                self.delta_dst.append(dst)
+                self.delta_type.append(torch.tensor([e[2] for e in edges]))
+                self._csr = None
+                if self.delta_src.size > self.compact_ratio*max(self.row.shape[0],1024):
+                    self.compact()
+            return changed,dst
+
+    def in_edges(self,nodes):
+        # Every incoming edge of `nodes`: (src node, position of its dst in `nodes`, edge type).
+        # Nodes added after the last compaction have no CSC edges (colptr clamps them to an empty range).
+        start = self.colptr[nodes.clamp(max=self.base_nodes)]
+        deg = self.colptr[(nodes+1).clamp(max=self.base_nodes)]-start
+        seg = torch.repeat_interleave(torch.arange(nodes.shape[0]),deg)
+        offset = torch.arange(seg.shape[0])-torch.repeat_interleave(deg.cumsum(0)-deg,deg)
+        eid = start[seg]+offset
+        src,etype = self.row[eid],self.edge_type[eid]
+        if self.delta_src.size:
+            hit = torch.isin(self.delta_dst.data,nodes)
+            if hit.any():
+                sorted_nodes,perm = nodes.sort()
+                delta_seg = perm[torch.searchsorted(sorted_nodes,self.delta_dst.data[hit])]
+                src,seg,etype = torch.cat([src,self.delta_src.data[hit]]),torch.cat([seg,delta_seg]),torch.cat([etype,self.delta_type.data[hit]])
+        return src,seg,etype
+
+    def out_neighbors(self,nodes):
+        """Unique dst nodes of the outgoing edges of `nodes`."""
+        with self.lock:
+            if self._csr is None:
+                perm = self.row.argsort()
+                rowptr = torch.zeros(self.base_nodes+1,dtype=torch.long)
+                rowptr[1:] = torch.bincount(self.row,minlength=self.base_nodes).cumsum(0)
+                self._csr = (rowptr,self.col[perm])
+            rowptr,col = self._csr
+            start = rowptr[nodes.clamp(max=self.base_nodes)]
+            deg = rowptr[(nodes+1).clamp(max=self.base_nodes)]-start
+            eid = torch.repeat_interleave(start-(deg.cumsum(0)-deg),deg)+torch.arange(int(deg.sum()))
+            dst = [col[eid]]
+            if self.delta_src.size:
+                dst.append(self.delta_dst.data[torch.isin(self.delta_src.data,nodes)])
+            return torch.unique(torch.cat(dst))
+
+    def sample(self,seeds,num_neighbors):
+        """Uniform sampling without replacement of up to k incoming edges per frontier node and hop.
+        Nodes are ordered seeds first, then by the hop that reached them."""
+        with self.lock:
+            n_id,frontier = [seeds],seeds
+            src_all,dst_all,type_all = [],[],[]
+            for k in num_neighbors:
+                src,seg,etype = self.in_edges(frontier)
+                if k >= 0 and src.shape[0] > 0:
+                    # random order inside each dst segment, keep the first k
+                    order = (seg.double()+torch.rand(seg.shape[0],dtype=torch.float64)).argsort()
+                    counts = torch.bincount(seg,minlength=frontier.shape[0])
+                    rank = torch.arange(order.shape[0])-torch.repeat_interleave(counts.cumsum(0)-counts,counts)
+                    keep = order[rank < k]
+                    src,seg,etype = src[keep],seg[keep],etype[keep]
+                src_all.append(src)
+                dst_all.append(frontier[seg])
+                type_all.append(etype)
+                new = torch.unique(src)
+                frontier = new[~torch.isin(new,torch.cat(n_id))]
+                n_id.append(frontier)
+            n_id = torch.cat(n_id)
+
+            sorted_id,perm = n_id.sort()
+            to_local = lambda x: perm[torch.searchsorted(sorted_id,x)]
+            edge_index = torch.stack([to_local(torch.cat(src_all)),to_local(torch.cat(dst_all))])
+            return Data(meta=self.meta[n_id],text=self.text_rows(n_id),edge_index=edge_index,edge_type=torch.cat(type_all),
+                        batch_size=seeds.shape[0],n_id=n_id,num_nodes=n_id.shape[0])
+
+################################################################################################
+class EmbeddingCache:
+    """Per-node meta/text encoder outputs, first RGCN layer outputs and bot probabilities of the exact
+    (full-neighborhood) forward pass. Every entry is computed on first use and stays valid until the
+    graph changes under it:
+      enc(v)  depends on the features of v
+      h1(v)   on enc of v and of its in-neighbors
+      prob(v) on h1 of v and of its in-neighbors
+    so a change is propagated along out-edges, one hop per layer."""
+    def __init__(self,model_f,model_c,graph,device="cpu"):
+        self.model_f = model_f
+        self.model_c = model_c
+        self.graph = graph
+        self.device = device
+        self.hidden_size = model_f.graph_encoder.gcn2.out_channels
+        self.capacity = 0
+        self.meta_feature = self.text_feature = self.h1 = self.prob = None
+        self.enc_valid = self.h1_valid = self.prob_valid = torch.zeros(0,dtype=torch.bool)
+        self.hits = 0
+        self.misses = 0
+        self._reserve(graph.num_nodes)
+
+    def _reserve(self,num_nodes):
+        if num_nodes <= self.capacity:
+            return
+        capacity = max(num_nodes,2*self.capacity)
+        def grow(old,shape,dtype,device):
+            new = torch.zeros((capacity,)+shape,dtype=dtype,device=device)
+            if old is not None:
+                new[:old.shape[0]] = old
+            return new
+        self.meta_feature = grow(self.meta_feature,(self.hidden_size,),torch.float32,self.device)
+        self.text_feature = grow(self.text_feature,(self.hidden_size,),torch.float32,self.device)
+        self.h1 = grow(self.h1,(self.hidden_size,),torch.float32,self.device)
+        self.prob = grow(self.prob,(),torch.float32,self.device)
+        self.enc_valid = grow(self.enc_valid,(),torch.bool,"cpu")
+        self.h1_valid = grow(self.h1_valid,(),torch.bool,"cpu")
+        self.prob_valid = grow(self.prob_valid,(),torch.bool,"cpu")
+        self.capacity = capacity
+
+    def invalidate(self,changed,edge_dst):
+        """changed: nodes whose features were written; edge_dst: dst nodes of added edges."""
+        with self.graph.lock:
+            self._reserve(self.graph.num_nodes)
+            self.enc_valid[changed] = False
+            h1_stale = torch.unique(torch.cat([changed,self.graph.out_neighbors(changed),edge_dst]))
+            self.h1_valid[h1_stale] = False
+            self.prob_valid[torch.cat([h1_stale,self.graph.out_neighbors(h1_stale)])] = False
+
+    def _layer(self,conv,table,nodes):
+        # One RGCN layer over every incoming edge of `nodes`, as a bipartite (in-neighbors -> nodes) conv
+        src,seg,etype = self.graph.in_edges(nodes)
+        src_nodes,src_local = torch.unique(src,return_inverse=True)
+        edge_index = torch.stack([src_local,seg]).to(self.device)
+        h = conv((table(src_nodes.to(self.device)),table(nodes.to(self.device))),edge_index,etype.to(self.device))
+        return self.model_f.graph_encoder.relu(h)
+
+    def _ensure_enc(self,nodes):
+        miss = nodes[~self.enc_valid[nodes]]
+        if miss.numel():
+            rows = miss.to(self.device)
+            self.meta_feature[rows] = self.model_f.meta_encoder(self.graph.meta[miss].to(self.device))
+            self.text_feature[rows] = self.model_f.text_encoder(self.graph.text_rows(miss).to(self.device))
+            self.enc_valid[miss] = True
+
+    def _ensure_h1(self,nodes):
+        miss = nodes[~self.h1_valid[nodes]]
+        if miss.numel():
+            src,_,_ = self.graph.in_edges(miss)
+            self._ensure_enc(torch.unique(torch.cat([miss,src])))
+            enc = lambda index: torch.cat([self.meta_feature[index],self.text_feature[index]],dim=1)
+            self.h1[miss.to(self.device)] = self._layer(self.model_f.graph_encoder.gcn1,enc,miss)
+            self.h1_valid[miss] = True
+
+    @torch.no_grad()
+    def predict(self,seeds):
+        with self.graph.lock:
+            self._reserve(self.graph.num_nodes)
+            miss = seeds[~self.prob_valid[seeds]]
+            self.hits += seeds.shape[0]-miss.shape[0]
+            self.misses += miss.shape[0]
+            if miss.numel():
+                src,_,_ = self.graph.in_edges(miss)
+                self._ensure_h1(torch.unique(torch.cat([miss,src])))
+                graph_feature = self._layer(self.model_f.graph_encoder.gcn2,lambda index: self.h1[index],miss)
+                rows = miss.to(self.device)
+                feature = self.model_f.fuse(graph_feature,self.text_feature[rows],self.meta_feature[rows])
+                self.prob[rows] = self.model_c(feature)[:,1]
+                self.prob_valid[miss] = True
+            return self.prob[seeds.to(self.device)].cpu()
+
+################################################################################################
+class BotScorer:
+    """Scores accounts with a trained (model_f, model_c) pair. Concurrent requests are merged into
+    micro-batches of up to max_batch accounts, waiting at most max_wait_ms for the batch to fill.
+    With embedding_cache, scores come from the exact full-neighborhood pass of an EmbeddingCache
+    instead of a sampled subgraph."""
+    def __init__(self,model_f,model_c,graph,num_neighbors=(256,256),max_batch=512,max_wait_ms=5.0,device="cpu",
+                 meta_scale=None,meta_shift=None,embedding_cache=False):
+        self.model_f = model_f
+        self.model_c = model_c
+        self.graph = graph
+        self.cache = EmbeddingCache(model_f,model_c,graph,device) if embedding_cache else None
+        self.num_neighbors = list(num_neighbors)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms/1000
+        self.device = device
+        self.meta_scale = meta_scale
+        self.meta_shift = meta_shift
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=10_000)
+        self.batch_sizes = deque(maxlen=10_000)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.worker = threading.Thread(target=self._run,daemon=True)
+        self.worker.start()
+
+    def submit(self,ids):
+        future = Future()
+        self.requests.put((list(ids),future,time.perf_counter()))
+        return future
+
+    def score(self,ids,timeout=None):
+        """Bot probability of every account in ids."""
+        return self.submit(ids).result(timeout)
+
+    def add_accounts(self,ids,meta=None,text=None,edges=None):
+        """Add or update accounts; meta is given as stored in the dataset files."""
+        if meta is not None and self.meta_scale is not None:
+            meta = meta*self.meta_scale+self.meta_shift
+        with self.graph.lock:
+            changed,edge_dst = self.graph.add_accounts(ids,meta,text,edges)
+            if self.cache is not None:
+                self.cache.invalidate(changed,edge_dst)
+        return changed
+
+    def stats(self):
+        latencies = np.array(self.latencies,dtype=np.float64)*1000
+        stats = {"queue_depth":self.requests.qsize(),
+                 "requests":self.num_requests,
+                 "errors":self.num_errors,
+                 "mean_batch_size":float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                 "p50_ms":float(np.percentile(latencies,50)) if latencies.size else None,
+                 "p99_ms":float(np.percentile(latencies,99)) if latencies.size else None}
+        if self.cache is not None:
+            lookups = self.cache.hits+self.cache.misses
+            stats["cache_hit_rate"] = self.cache.hits/lookups if lookups else None
+        return stats
+
+    def _run(self):
+        while True:
+            pending = [self.requests.get()]
+            n = len(pending[0][0])
+            deadline = time.perf_counter()+self.max_wait
+            while n < self.max_batch:
+                timeout = deadline-time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n += len(pending[-1][0])
+            self._score_batch(pending)
+
+    @torch.no_grad()
+    def predict(self,seeds):
+        if self.cache is not None:
+            return self.cache.predict(seeds)
+        batch = self.graph.sample(seeds,self.num_neighbors).to(self.device)
+        feature = self.model_f([[batch.meta,batch.text],batch.edge_index,batch.edge_type])
+        prob = self.model_c(feature[:batch.batch_size])
+        return prob[:,1].cpu()
+
+    def _score_batch(self,pending):
+        indices = []
+        for ids,future,_ in pending:
+            try:
+                indices.append(self.graph.lookup(ids))
+            except Exception as err:
+                indices.append(None)
+                future.set_exception(err)
+        valid = [index for index in indices if index is not None]
+        if valid:
+            try:
+                seeds = torch.unique(torch.cat(valid))
+                prob = self.predict(seeds)
+            except Exception as err:
+                prob,seeds = err,None
+            for (ids,future,start),index in zip(pending,indices):
+                if index is None:
+                    continue
+                if isinstance(prob,Exception):
+                    future.set_exception(prob)
+                else:
+                    future.set_result(prob[torch.searchsorted(seeds,index)].tolist())
+                self.latencies.append(time.perf_counter()-start)
+            self.batch_sizes.append(int(seeds.shape[0]) if seeds is not None else 0)
+        self.num_requests += len(pending)
+        self.num_errors += sum(future.exception() is not None for _,future,_ in pending)
+
+################################################################################################
+def make_handler(scorer):
+    class Handler(BaseHTTPRequestHandler):
+        # POST /score    {"ids": [...]}                                   -> {"ids": [...], "bot_prob": [...]}
+        # POST /accounts {"ids": [...], "meta": [[...]], "text": [[...]], "edges": [[src,dst,type], ...]}
+        # GET  /stats                                                     -> queue depth, p50/p99 latency
+        def _reply(self,code,body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type","application/json")
+            self.send_header("Content-Length",str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200,scorer.stats())
+            else:
+                self._reply(404,{"error":"not found"})
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length",0))) or b"{}")
+                if self.path == "/score":
+                    self._reply(200,{"ids":body["ids"],"bot_prob":scorer.score(body["ids"])})
+                elif self.path == "/accounts":
+                    meta = torch.tensor(body["meta"],dtype=torch.float32) if body.get("meta") is not None else None
+                    text = torch.tensor(body["text"],dtype=torch.float32) if body.get("text") is not None else None
+                    scorer.add_accounts(body["ids"],meta,text,body.get("edges"))
+                    self._reply(200,{"num_nodes":scorer.graph.num_nodes})
+                else:
+                    self._reply(404,{"error":"not found"})
+            except KeyError as err:
+                self._reply(400,{"error":str(err)})
+            except Exception as err:
+                self._reply(500,{"error":repr(err)})
+
+        def log_message(self,format,*args):
+            pass
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online bot scoring service")
+    parser.add_argument('--model', type=str, required=True, help="checkpoint written with --save_path")
+    parser.add_argument('--data_root_path', type=str, default="./Pre_Data/T_22_com/")
+    parser.add_argument('--com', type=int, default=None, help="community graph to serve (cross-community models)")
+    parser.add_argument('--name', type=str, default=None, help="dataset graph to serve (cross-dataset models)")
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--num_neighbors', type=str, default="256,256")
+    parser.add_argument('--max_batch', type=int, default=512)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0)
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--embedding_cache', action='store_true', help="exact full-neighborhood scores, cached per account until its 2-hop in-neighborhood changes")
+    parser.add_argument('--compact_ratio', type=float, default=0.25, help="merge appended edges into the CSC index once they exceed this fraction of it")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    assert (args.com is None) != (args.name is None), "give exactly one of --com / --name"
+    print(args)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model_f,model_c,checkpoint = load_model(args.model,args.device)
+    if args.compile:
+        model_f.forward = torch.compile(model_f.forward,dynamic=True)
+    meta,text,edge_index,edge_type,ids,text_scale = load_graph(args.data_root_path,args.com,args.name,args.packed)
+    meta_scale,meta_shift = checkpoint["meta_scale"],checkpoint["meta_shift"]
+    if meta_scale is not None:
+        meta_scale,meta_shift = meta_scale.cpu().float(),meta_shift.cpu().float()
+        meta = meta*meta_scale+meta_shift
+    graph = GraphIndex(meta,text,edge_index,edge_type,ids,args.compact_ratio,text_scale)
+    print(f"Graph: {graph.num_nodes} accounts, {graph.num_edges} edges")
+
+    scorer = BotScorer(model_f,model_c,graph,[int(k) for k in args.num_neighbors.split(",")],args.max_batch,args.max_wait_ms,args.device,
+                       meta_scale,meta_shift,args.embedding_cache)
+    server = ThreadingHTTPServer((args.host,args.port),make_handler(scorer))
+    print(f"Serving on http://{args.host}:{args.port} (POST /score, POST /accounts, GET /stats)")
+    server.serve_forever()
@@ -0,0 +1,127 @@
+import argparse
+import csv
+import os
+import re
+import subprocess
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor,as_completed
+
+###
+# Runs every (src, tgt, seed) job of a sweep as its own single-exp training process.
+# Use --packed (after AdaBot-convert.py) so all workers memory-map the same read-only
+# files and share them through the page cache instead of each holding a private copy.
+###
+
+SCRIPTS = {"community":"AdaBot-cross-community.py","dataset":"AdaBot-cross-dataset.py"}
+RESULT_PATTERN = re.compile(r"^@@@@@@ .*?: (.*)$",re.M)
+METRIC_PATTERN = re.compile(r"Mean (\w+) (-?[\d.]+|nan)")
+
+
+def get_time():
+    return str(time.strftime("[%Y-%m-%d %H:%M:%S]", time.localtime()))
+
+
+def all_com_pairs():
+    # Same pairs as --exp_all in AdaBot-cross-community.py
+    pairs = []
+    for group in (range(5,10),range(5)):
+        for i in group:
+            for j in group:
+                if i != j:
+                    pairs.append((str(i),str(j)))
+    return pairs
+
+
+def parse_pairs(v):
+    return [tuple(pair.split("-")) for pair in v.split(",")]
+
+
+def job_command(args,src,tgt,seed,extra):
+    cmd = [args.python,os.path.join(os.path.dirname(os.path.abspath(__file__)),SCRIPTS[args.mode]),
+           "--exp_times","1","--seed",str(seed)]
+    if args.mode == "community":
+        # same target split in every job, so the spread over seeds is run variance only
+        cmd += ["--exp_all","false","--coms",f"{src}-{tgt}","--split_seed",str(args.split_seed)]
+    else:
+        cmd += ["--src_data",src,"--tgt_data",tgt]
+    return cmd+extra
+
+
+def run_job(args,src,tgt,seed,extra):
+    env = dict(os.environ)
+    for key in ("OMP_NUM_THREADS","MKL_NUM_THREADS","OPENBLAS_NUM_THREADS"):
+        env[key] = str(args.threads)
+    log_path = os.path.join(args.log_dir,f"{args.mode}_{src}-{tgt}_seed{seed}.log")
+    with open(log_path,"w") as log:
+        returncode = subprocess.call(job_command(args,src,tgt,seed,extra),stdout=log,stderr=subprocess.STDOUT,env=env)
+    with open(log_path) as log:
+        output = log.read()
+    matches = RESULT_PATTERN.findall(output)
+    metrics = OrderedDict((name,float(value)) for name,value in METRIC_PATTERN.findall(matches[-1])) if matches else None
+    return returncode,metrics,log_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel (src, tgt, seed) sweep scheduler")
+    parser.add_argument('--mode', type=str, default="community", help="community, dataset")
+    parser.add_argument('--pairs', type=parse_pairs, default=None, help="e.g. 5-6,6-5 or C_15-T_20 (default: every --exp_all pair / C_15-T_20)")
+    parser.add_argument('--exp_times', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--split_seed', type=int, default=0, help="community mode: target split seed, the same for every job")
+    parser.add_argument('--threads', type=int, default=1, help="torch/BLAS threads per worker")
+    parser.add_argument('--workers', type=int, default=None, help="default: cores // threads")
+    parser.add_argument('--python', type=str, default=sys.executable)
+    parser.add_argument('--log_dir', type=str, default="./sweep_logs")
+    parser.add_argument('--out', type=str, default="./sweep_results.csv")
+    args,extra = parser.parse_known_args()
+    if args.pairs is None:
+        args.pairs = all_com_pairs() if args.mode == "community" else [("C_15","T_20")]
+    if args.workers is None:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os,"sched_getaffinity") else os.cpu_count()
+        args.workers = max(1,cores//args.threads)
+    if "--packed" not in extra:
+        print("Note: without --packed every worker holds its own copy of the datasets", file=sys.stderr)
+    print(args,"passthrough:",extra)
+    os.makedirs(args.log_dir,exist_ok=True)
+
+    jobs = [(src,tgt,args.seed+e) for src,tgt in args.pairs for e in range(args.exp_times)]
+    results = OrderedDict((pair,[]) for pair in args.pairs)
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_job,args,src,tgt,seed,extra):(src,tgt,seed) for src,tgt,seed in jobs}
+        for n,future in enumerate(as_completed(futures),1):
+            src,tgt,seed = futures[future]
+            returncode,metrics,log_path = future.result()
+            if returncode != 0 or metrics is None:
+                failed.append((src,tgt,seed))
+                print(get_time(),f"[{n}/{len(jobs)}] FAILED {src}->{tgt} seed {seed} (exit {returncode}), see {log_path}")
+                continue
+            results[(src,tgt)].append(metrics)
+            print(get_time(),f"[{n}/{len(jobs)}] {src}->{tgt} seed {seed}:",", ".join(f"{k} {v:.4f}" for k,v in metrics.items()))
+
+    rows = []
+    for (src,tgt),runs in results.items():
+        if not runs:
+            continue
+        row = OrderedDict([("src",src),("tgt",tgt),("runs",len(runs))])
+        summary = []
+        for name in runs[0]:
+            values = np.array([run[name] for run in runs],dtype=np.float32)
+            row[f"mean_{name}"],row[f"std_{name}"] = float(values.mean()),float(values.std())
+            summary.append(f"Mean {name} {values.mean():>0.4f}, Std {name} {values.std():>0.4f}")
+        rows.append(row)
+        print(f"@@@@@@ Source {src}, Target {tgt} ({len(runs)} runs): "+"; ".join(summary))
+
+    if rows:
+        with open(args.out,"w",newline="") as f:
+            writer = csv.DictWriter(f,fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Result table written to {args.out}")
+    if failed:
+        print(f"{len(failed)} job(s) failed:",failed)
+    print("Done!")
+    sys.exit(1 if failed else 0)
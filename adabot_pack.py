@@ -0,0 +1,84 @@
+import torch
+import numpy as np
+import json
+import os
+from collections import OrderedDict
+
+###
+# The packed single-file dataset format, shared by AdaBot-convert.py (writer), the training scripts
+# and AdaBot-serve.py (readers).
+#
+# Layout of a packed file:
+#   8 bytes   magic b"ADABOTPK"
+#   8 bytes   little-endian header length
+#   header    utf-8 json {"attrs": {...}, "fields": {name: {"dtype","shape","offset"}}}
+#   arrays    one contiguous C-order array per field, each starting on a PACK_ALIGN boundary;
+#             "offset" is relative to the first aligned byte after the header
+#
+# attrs["text_dtype"] records how text is stored: float32/float16 as is, bfloat16 as its raw bits
+# in int16 (numpy has no bfloat16), int8 with a per-row float32 "text_scale" field.
+###
+
+PACK_MAGIC = b"ADABOTPK"
+PACK_ALIGN = 64
+
+
+def _align(n):
+    return (n+PACK_ALIGN-1)//PACK_ALIGN*PACK_ALIGN
+
+
+def write_packed(path,fields,attrs):
+    arrays = OrderedDict((name,np.ascontiguousarray(value.cpu().numpy())) for name,value in fields.items())
+    specs = OrderedDict()
+    offset = 0
+    for name,arr in arrays.items():
+        specs[name] = {"dtype":arr.dtype.str,"shape":list(arr.shape),"offset":offset}
+        offset = _align(offset+arr.nbytes)
+    header = json.dumps({"attrs":attrs,"fields":specs}).encode("utf-8")
+    data_start = _align(len(PACK_MAGIC)+8+len(header))
+
+    tmp_path = path+".tmp"
+    with open(tmp_path,"wb") as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header).to_bytes(8,"little"))
+        f.write(header)
+        for name,arr in arrays.items():
+            f.seek(data_start+specs[name]["offset"])
+            f.write(arr.tobytes(order="C"))
+        f.truncate(data_start+offset)
+    os.replace(tmp_path,path)
+
+
+def load_packed(path):
+    # Arrays are memory-mapped copy-on-write, so only the rows a batch gathers are ever paged in
+    with open(path,"rb") as f:
+        assert f.read(len(PACK_MAGIC)) == PACK_MAGIC, f"{path} is not a packed AdaBot dataset"
+        header_len = int.from_bytes(f.read(8),"little")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _align(len(PACK_MAGIC)+8+header_len)
+
+    fields = OrderedDict()
+    for name,spec in header["fields"].items():
+        dtype,shape = np.dtype(spec["dtype"]),tuple(spec["shape"])
+        if int(np.prod(shape)) == 0:
+            arr = np.empty(shape,dtype=dtype)
+        else:
+            arr = np.memmap(path,dtype=dtype,mode="c",offset=data_start+spec["offset"],shape=shape)
+        fields[name] = torch.from_numpy(arr)
+    if header["attrs"].get("text_dtype") == "bfloat16":
+        fields["text"] = fields["text"].view(torch.bfloat16)
+    return header["attrs"],fields
+
+
+def quantize_text(text,dtype):
+    # -> (text, per-row scale); the scale is None except for int8 (symmetric, one scale per row)
+    if dtype == "int8":
+        scale = text.float().abs().amax(dim=1).clamp(min=1e-12)/127
+        return torch.round(text.float()/scale.unsqueeze(1)).to(torch.int8),scale
+    return text.to(getattr(torch,dtype)),None
+
+
+def dequantize_text(text,scale=None):
+    if scale is not None:
+        return text.float()*scale.to(text.device).unsqueeze(1)
+    return text.float()